@@ -0,0 +1,289 @@
+'''
+Micro-benchmarks for the text processing helpers, run on synthetic data
+since the textbooks themselves are not released. Each benchmark also checks
+that the fast path gives the same output as the original implementation.
+
+python benchmarks.py clean_text --num_sents 100000
+python benchmarks.py stem
+python benchmarks.py lda --num_sents 20000 [--mallet_dir ...]
+python benchmarks.py people_location --num_sents 50000
+'''
+import argparse
+import random
+import re
+import tempfile
+import time
+import numpy as np
+from nltk import ngrams
+from helpers import *
+from lexicon import Lexicon, SentenceMatcher, tokenize_term
+from topic_models import GibbsBackend, MalletBackend
+
+parser = argparse.ArgumentParser()
+parser.add_argument('benchmark', choices=['clean_text', 'stem', 'lda', 'people_location'])
+parser.add_argument('--num_sents', default=50000, type=int, help="Number of synthetic sentences.")
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--num_topics', default=20, type=int)
+parser.add_argument('--mallet_dir', help="Also time ./mallet.sh on the same corpus.")
+
+def legacy_clean_text(text,
+               remove_stopwords=True,
+               remove_numeric=True,
+               stem=False,
+               remove_short=True,
+               round_dates=False):
+    '''
+    helpers.clean_text as it was before TextNormalizer, kept as the baseline.
+    '''
+    text = text.lower()
+    text = re.sub(r'http\S*|\S*\.com\S*|\S*www\S*', ' ', text)
+    text = replace.sub(' ', text)
+    text = re.sub(r'\s+', ' ', text)
+    text = text.strip()
+    text = ''.join([c for c in text if c in printable])
+    words = text.split()
+    if remove_stopwords:
+        words = [w for w in words if w not in stopwords]
+    if remove_numeric:
+        words = [w for w in words if not w.isdigit()]
+    if round_dates:
+        new_words = []
+        for w in words:
+            if len(w) == 4 and (w.startswith('1') or w.startswith('2')) and w.isdigit():
+                rounded = str(int(round(int(w), -1)))
+                new_words.append(rounded)
+            else:
+                new_words.append(w)
+        words = new_words
+    if stem:
+        words = [sno.stem(w) for w in words]
+    if remove_short:
+        words = [w for w in words if len(w) >= 3]
+    return words
+
+def synthetic_sentences(num_sents, seed=0):
+    '''
+    Textbook-like sentences: a mix of stopwords, content words, years,
+    numbers, punctuation, urls and a few non-ascii characters.
+    '''
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    content = [''.join(rng.choice(letters) for _ in range(rng.randint(2, 10))) for _ in range(5000)]
+    content += ['Chinese', 'Japanese-Americans', 'immigrants', "workers'", 'Indian', 'U.S.']
+    extras = ['1848', '1942', '2001', '12', '3,000', '—', '“', '”', ';', '(', ')', 'café',
+              'naïve', 'www.loc.gov', 'http://example.com/a', 'e.g.', '\xa0', '…', '•']
+    stops = [w for w in stopwords if w]
+    sents = []
+    for _ in range(num_sents):
+        words = []
+        for _ in range(rng.randint(5, 40)):
+            r = rng.random()
+            if r < 0.45:
+                words.append(rng.choice(stops))
+            elif r < 0.9:
+                words.append(rng.choice(content))
+            else:
+                words.append(rng.choice(extras))
+        words[0] = words[0].title()
+        sents.append(' '.join(words) + rng.choice(['.', '?', '!', '."']))
+    return sents
+
+def time_it(func):
+    start = time.perf_counter()
+    res = func()
+    return res, time.perf_counter() - start
+
+def benchmark_clean_text(sents):
+    option_sets = [
+        {'round_dates': True},
+        {'round_dates': True, 'stem': True},
+        {'remove_stopwords': False, 'remove_numeric': False, 'remove_short': False},
+    ]
+    for options in option_sets:
+        print(options)
+        old, old_time = time_it(lambda: [legacy_clean_text(s, **options) for s in sents])
+        normalizer = TextNormalizer(**options)
+        new, new_time = time_it(lambda: list(normalizer.clean_texts(sents)))
+        assert old == new, "TextNormalizer output differs from clean_text"
+        print("\tlegacy clean_text: %.0f sents/sec" % (len(sents) / old_time))
+        print("\tTextNormalizer:    %.0f sents/sec" % (len(sents) / new_time))
+        print("\tspeedup: %.1fx" % (old_time / new_time))
+
+def benchmark_stem(sents):
+    '''
+    Stemming every token occurrence vs. a StemCache, cold and warm-started
+    from a saved table.
+    '''
+    normalizer = TextNormalizer(round_dates=True)
+    tokens = [w for words in normalizer.clean_texts(sents) for w in words]
+    print(len(tokens), "tokens,", len(set(tokens)), "types")
+    old, old_time = time_it(lambda: [sno.stem(w) for w in tokens])
+    cache = StemCache()
+    new, cold_time = time_it(lambda: cache.stem_words(tokens))
+    assert old == new, "StemCache output differs from SnowballStemmer"
+    warm = StemCache(table=cache.table)
+    _, warm_time = time_it(lambda: warm.stem_words(tokens))
+    print("\tno cache:   %.0f tokens/sec" % (len(tokens) / old_time))
+    print("\tcold cache: %.0f tokens/sec" % (len(tokens) / cold_time))
+    print("\twarm cache: %.0f tokens/sec" % (len(tokens) / warm_time))
+    print("\tspeedup: %.1fx cold, %.1fx warm" % (old_time / cold_time, old_time / warm_time))
+
+def synthetic_lda_corpus(num_docs, num_topics, vocab_size=2000, seed=0):
+    '''
+    Sentence-length docs sampled from an LDA model, as (word_ids, doc_starts).
+    '''
+    rng = np.random.RandomState(seed)
+    topic_words = rng.dirichlet(np.full(vocab_size, 0.05), size=num_topics)
+    word_ids = []
+    doc_starts = [0]
+    for _ in range(num_docs):
+        theta = rng.dirichlet(np.full(num_topics, 0.1))
+        topics = rng.choice(num_topics, size=rng.randint(5, 20), p=theta)
+        word_ids.extend(rng.choice(vocab_size, p=topic_words[k]) for k in topics)
+        doc_starts.append(len(word_ids))
+    return np.array(word_ids, dtype=np.int32), np.array(doc_starts, dtype=np.int64), vocab_size
+
+def benchmark_lda(num_docs, num_topics, mallet_dir=None, max_iterations=500, tol=1e-3):
+    '''
+    Iterations/sec of the Gibbs backend and wall time until the log
+    likelihood per token changes by less than @tol between reports.
+    '''
+    word_ids, doc_starts, vocab_size = synthetic_lda_corpus(num_docs, num_topics)
+    print(num_docs, "docs,", len(word_ids), "tokens")
+    backend = GibbsBackend(report_every=10)
+    # compile outside the timed run
+    backend.fit(num_topics, word_ids[:doc_starts[10]], doc_starts[:11], vocab_size, num_iterations=1)
+    backend.fit(num_topics, word_ids, doc_starts, vocab_size, num_iterations=max_iterations)
+    converged = backend.history[-1]
+    for prev, curr in zip(backend.history, backend.history[1:]):
+        if abs(curr[2] - prev[2]) < tol:
+            converged = curr
+            break
+    iterations, seconds, ll = backend.history[-1]
+    print("\tgibbs: %.1f iterations/sec" % (iterations / seconds))
+    print("\tgibbs: converged after %d iterations, %.1f sec, LL/token %.4f" % converged)
+    if mallet_dir:
+        output_dir = tempfile.mkdtemp()
+        with open(output_dir + '/data.input', 'w') as fout:
+            for d in range(len(doc_starts) - 1):
+                ids = sorted(word_ids[doc_starts[d]:doc_starts[d + 1]])
+                fout.write("%d %s\n" % (d + 1, " ".join(str(w) for w in ids)))
+        _, mallet_time = time_it(lambda: MalletBackend(mallet_dir).train(output_dir, num_topics))
+        print("\tmallet.sh: %.1f sec wall time" % mallet_time)
+
+def get_n_gramlist(nngramlist, toks, n=2):
+    for s in ngrams(toks,n=n):
+        nngramlist.append(' '.join(s))
+    return nngramlist
+
+def legacy_match_sentence(words, chunks, sentence_ID, results, matcher, lexicon):
+    '''
+    The matching in people_location.match_sentences before SentenceMatcher,
+    for one sentence, kept as the baseline.
+    '''
+    use_rules = matcher.use_rules
+    toks = [w.lower() for w in words]
+    for term in matcher.sent_matcher.terms_in(toks, use_rules=use_rules):
+        results['term'][term].append(sentence_ID)
+    is_aapi = False
+    for start, end, root, text in chunks:
+        toks = [w.lower() for w in words[start:end]]
+        ngramlist = [w.lower() for w in words[start:end]]
+        ngramlist = get_n_gramlist(ngramlist, toks, n=2)
+        ngramlist = get_n_gramlist(ngramlist, toks, n=3)
+        for term in matcher.chunk_matcher.terms_in(toks, use_rules=use_rules):
+            results['noun'][term].append(text.strip())
+        if words[root].lower() not in lexicon.all_terms:
+            continue
+        for ngram in ngramlist:
+            if use_rules and ngram.startswith('indian') and 'asian' not in set(toks):
+                results['race_eth']['all'] += 1
+                continue
+            if ngram in lexicon.aapi_terms:
+                is_aapi = True
+                results['location'][ngram].append(sentence_ID)
+            if ngram in lexicon.race_eth_cats:
+                results['race_eth'][lexicon.race_eth_cats[ngram]] += 1
+            if ngram in lexicon.all_terms:
+                results['race_eth']['all'] += 1
+    return is_aapi
+
+def synthetic_parsed_sentences(num_sents, lexicon, seed=0):
+    '''
+    Sentences as spaCy would give them to people_location.py: tokens, and
+    noun chunks as (start, end, root, text). People terms, "Indian" and
+    "Asian", dashed terms split the way spaCy splits them and the odd
+    whitespace token are mixed into random words.
+    '''
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    content = [''.join(rng.choice(letters) for _ in range(rng.randint(2, 10))) for _ in range(3000)]
+    terms = sorted(lexicon.aapi_terms | lexicon.all_terms)
+    special = ['Indian', 'Indians', 'Indiana', 'Asian', 'American', 'the', ',', '.', ' ']
+    sents = []
+    for _ in range(num_sents):
+        words = []
+        for _ in range(rng.randint(5, 40)):
+            r = rng.random()
+            if r < 0.2:
+                toks = tokenize_term(rng.choice(terms))
+                words.extend([t.title() for t in toks] if rng.random() < 0.5 else toks)
+            elif r < 0.3:
+                words.append(rng.choice(special))
+            else:
+                words.append(rng.choice(content))
+        chunks = []
+        start = rng.randint(0, 3)
+        while start < len(words):
+            end = min(len(words), start + rng.randint(1, 4))
+            root = end - 1 if rng.random() < 0.8 else rng.randrange(start, end)
+            chunks.append((start, end, root, ' '.join(words[start:end])))
+            start = end + rng.randint(0, 4)
+        sents.append((words, chunks))
+    return sents
+
+def benchmark_people_location(num_sents, seed=0):
+    '''
+    people_location.py's matching of terms, noun chunks and race/ethnicity
+    counts in parsed sentences, without spaCy.
+    '''
+    lexicon = Lexicon.load('wordlists/people_terms.csv')
+    sents = synthetic_parsed_sentences(num_sents, lexicon, seed=seed)
+    print(num_sents, "sentences,", sum(len(words) for words, _ in sents), "tokens")
+    def new_results():
+        return {'location': defaultdict(list), 'term': defaultdict(list), 'noun': defaultdict(list),
+                'race_eth': Counter()}
+    for use_rules in (True, False):
+        print("use_rules", use_rules)
+        matcher = SentenceMatcher.from_people_terms('wordlists/people_terms.csv', use_rules=use_rules)
+        old_results = new_results()
+        old, old_time = time_it(lambda: [legacy_match_sentence(words, chunks, i, old_results, matcher, lexicon)
+                                         for i, (words, chunks) in enumerate(sents)])
+        new_results_ = new_results()
+        new, new_time = time_it(lambda: [matcher.match([w.lower() for w in words], chunks, i, new_results_)
+                                         for i, (words, chunks) in enumerate(sents)])
+        assert old == new, "SentenceMatcher AAPI flags differ"
+        for name in old_results:
+            # Counter key order ends up in the json output
+            assert list(old_results[name].items()) == list(new_results_[name].items()), \
+                "SentenceMatcher %s hits differ" % name
+        print("\tlegacy matching:  %.0f sents/sec" % (num_sents / old_time))
+        print("\tSentenceMatcher:  %.0f sents/sec" % (num_sents / new_time))
+        print("\tspeedup: %.1fx" % (old_time / new_time))
+
+def main():
+    args = parser.parse_args()
+    if args.benchmark == 'people_location':
+        benchmark_people_location(args.num_sents, seed=args.seed)
+        return
+    if args.benchmark == 'lda':
+        benchmark_lda(args.num_sents, args.num_topics, mallet_dir=args.mallet_dir)
+        return
+    sents = synthetic_sentences(args.num_sents, seed=args.seed)
+    if args.benchmark == 'clean_text':
+        benchmark_clean_text(sents)
+    elif args.benchmark == 'stem':
+        benchmark_stem(sents)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+Checkpoints for long parsing runs, so a crashed run can be resumed.
+
+A checkpoint is a small json file next to the output with how far the
+run got, e.g. the number of input rows done and the size of the output
+file at that point. Output is flushed to disk before the checkpoint is
+written, and the checkpoint is replaced atomically, so it never points
+past output that was not written. On resume, output written after the
+last checkpoint is cut off and the run carries on from there, so the
+final output is the same as an uninterrupted run's.
+
+checkpoint = Checkpoint(output_file + '.checkpoint', resume=args.resume,
+                        config={'input_dir': args.input_dir})
+done = checkpoint.get('rows', 0)
+truncate_output(output_file, checkpoint.get('bytes'))
+...
+flush_output(outfile)
+checkpoint.commit(rows=done, bytes=os.path.getsize(output_file))
+...
+checkpoint.finish()
+'''
+import json
+import os
+
+class Checkpoint(object):
+    '''
+    Saved state of a run at @path. Without @resume, or if there is no
+    checkpoint yet, the run starts from an empty state. @config holds the
+    options that change the output, and resuming a checkpoint written
+    with a different config raises a ValueError.
+    '''
+    def __init__(self, path, resume=False, config=None):
+        self.path = path
+        self.config = config or {}
+        self.state = {}
+        self.resumed = False
+        if resume and os.path.exists(path):
+            with open(path, 'r') as infile:
+                saved = json.load(infile)
+            if saved['config'] != self.config:
+                raise ValueError("%s was written with %s, not %s" % (path, saved['config'], self.config))
+            self.state = saved['state']
+            self.resumed = True
+        elif resume:
+            print("No checkpoint at", path, "so starting from the beginning")
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def commit(self, **state):
+        '''
+        Updates the state and writes it out. Output it refers to should
+        already be flushed with flush_output().
+        '''
+        self.state.update(state)
+        with open(self.path + '.tmp', 'w') as outfile:
+            json.dump({'config': self.config, 'state': self.state}, outfile)
+            flush_output(outfile)
+        os.replace(self.path + '.tmp', self.path)
+
+    def finish(self):
+        '''
+        Removes the checkpoint once the run is done.
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def flush_output(outfile):
+    outfile.flush()
+    os.fsync(outfile.fileno())
+
+def truncate_output(path, size):
+    '''
+    Cuts @path back to @size bytes, dropping output written after the
+    last checkpoint. Does nothing if @size is None.
+    '''
+    if size is None:
+        return
+    with open(path, 'r+b') as outfile:
+        outfile.truncate(size)
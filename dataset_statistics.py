@@ -6,56 +6,153 @@ the following:
 # of unique tokens (vocabulary)
 
 In addition, it outputs a file 
+
+Books are counted one at a time, or on a process pool with --num_workers.
+With --stats_cache, each book's counts are saved under a hash of the book,
+so a rerun only counts books that changed. With --approximate, unique
+tokens are counted with a HyperLogLog sketch of fixed size instead of a
+set of every token, and the table is written to _stats_approximate.csv.
 """
 
 import spacy
 from helpers import *
 from collections import defaultdict, Counter
+import base64
+import gzip
+import hashlib
 import json
 import argparse
+import multiprocessing
 import os
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_dir', required=True)
 parser.add_argument('--output_prefix', required=True)
+parser.add_argument('--num_workers', default=1, type=int, help="Processes counting whole books at once.")
+parser.add_argument('--stats_cache', help="Folder of each book's counts, keyed by a hash of the book file.")
+parser.add_argument('--approximate', action='store_true', help="Count unique tokens with a HyperLogLog sketch "
+                                                               "(see helpers.HyperLogLog), in bounded memory.")
+parser.add_argument('--hll_precision', default=14, type=int, help="The sketch has 2^hll_precision registers.")
+parser.add_argument('--batch_size', default=256, type=int, help="Lines per nlp.pipe batch.")
 
 args = parser.parse_args()
 
-def main(): 
+# model and books of this process, loaded once by init_worker()
+worker = {}
+
+def init_worker(): 
     nlp = spacy.load('en_core_web_trf', exclude=["transformer", "ner", "tagger", "parser", "attribute_ruler", "lemmatizer"])
     nlp.add_pipe('sentencizer')
+    worker['nlp'] = nlp
+    # cached counts are redone if the model changes
+    worker['pipeline'] = '%s-%s' % (nlp.meta.get('name', ''), nlp.meta.get('version', ''))
+    worker['books'] = Corpus(args.input_dir)
+
+def new_vocab(): 
+    if args.approximate: 
+        return HyperLogLog(p=args.hll_precision)
+    return set()
+
+def cache_path(title, digest): 
+    mode = 'hll%d' % args.hll_precision if args.approximate else 'exact'
+    key = hashlib.sha1(('%s %s %s' % (digest, worker['pipeline'], mode)).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(args.stats_cache, '%s.%s.json.gz' % (title, key))
+
+def save_stats(path, stats): 
+    data = dict(stats)
+    if args.approximate: 
+        data['vocab'] = base64.b64encode(stats['vocab'].registers.tobytes()).decode('ascii')
+    else: 
+        data['vocab'] = sorted(stats['vocab'])
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as outfile: 
+        json.dump(data, outfile)
+    os.replace(path + '.tmp', path)
+
+def load_stats(path): 
+    with gzip.open(path, 'rt', encoding='utf-8') as infile: 
+        stats = json.load(infile)
+    if args.approximate: 
+        registers = np.frombuffer(base64.b64decode(stats['vocab']), dtype=np.uint8).copy()
+        stats['vocab'] = HyperLogLog(p=args.hll_precision, registers=registers)
+    else: 
+        stats['vocab'] = set(stats['vocab'])
+    return stats
+
+def count_book(title): 
+    '''
+    Returns the title and {lines, sentences, tokens, vocab} of one book,
+    where vocab is the set (or sketch) of lowercased tokens.
+    '''
+    books = worker['books']
+    path = None
+    if args.stats_cache: 
+        path = cache_path(title, file_digest(books.files[title]))
+        if os.path.exists(path): 
+            return title, load_stats(path)
+    stats = {'lines': 0, 'sentences': 0, 'tokens': 0, 'vocab': new_vocab()}
+    lines = tqdm(books.lines(title), total=books.num_lines(title), disable=args.num_workers > 1)
+    for doc in worker['nlp'].pipe(lines, batch_size=args.batch_size): 
+        stats['lines'] += 1
+        stats['sentences'] += len(list(doc.sents))
+        stats['tokens'] += len(doc)
+        stats['vocab'].update(token.text.lower() for token in doc)
+    if path is not None: 
+        save_stats(path, stats)
+    return title, stats
+
+def map_books(titles): 
+    '''
+    Runs count_book on each title, on a process pool if num_workers > 1.
+    '''
+    if args.num_workers <= 1: 
+        init_worker()
+        for title in titles: 
+            print(title)
+            yield count_book(title)
+        return
+    with multiprocessing.Pool(args.num_workers, initializer=init_worker) as pool: 
+        for result in tqdm(pool.imap_unordered(count_book, titles), total=len(titles)): 
+            yield result
+
+def main(): 
+    books = Corpus(args.input_dir)
+    if args.stats_cache: 
+        os.makedirs(args.stats_cache, exist_ok=True)
+
+    # each book's vocab is added to the overall one as soon as it is 
+    # counted, so only one book's vocab is held at a time
+    book_counts = {}
+    all_tokens = new_vocab()
+    for title, stats in map_books(books.titles()): 
+        book_counts[title] = (stats['lines'], [stats['sentences'], stats['tokens'], len(stats['vocab'])])
+        if args.approximate: 
+            all_tokens.merge(stats['vocab'])
+        else: 
+            all_tokens.update(stats['vocab'])
     
-    books = get_book_txts(args.input_dir, splitlines=True)
-    
-    num_sents = Counter()
-    num_tokens = Counter()
-    token_set = defaultdict(set)
-    
-    for title, textbook_lines in books.items():
-        print(title)
-        for line in tqdm(textbook_lines):
-            doc = nlp(line, disable=["transformer", "ner", "tagger", "parser", "attribute_ruler", "lemmatizer"])
-            
-            num_sents[title] += len(list(doc.sents))
-            num_tokens[title] += len(doc)
-            for token in doc: 
-                token_set[title].add(token.text.lower())
-    
+    # rows in title order, whatever order books were counted in
     data = {}
-    all_tokens = set()
-    for title in num_sents: 
-        data[title] = [num_sents[title], num_tokens[title], len(token_set[title])]
-        all_tokens.update(token_set[title])
-    
-    data['OVERALL'] = [sum(num_sents.values()), sum(num_tokens.values()), len(all_tokens)]
+    for title in books.titles(): 
+        num_lines, row = book_counts[title]
+        # a book with no lines has no row
+        if num_lines > 0: 
+            data[title] = row
+    num_sents = sum(row[0] for row in data.values())
+    num_tokens = sum(row[1] for row in data.values())
     
+    data['OVERALL'] = [num_sents, num_tokens, len(all_tokens)]
+
     df = pd.DataFrame.from_dict(data, orient='index',
                        columns=['Sentences', 'Tokens', 'Unique Tokens'])
-    
-    df.to_csv(args.output_prefix + '_stats.csv')
 
-if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if args.approximate: 
+        df.to_csv(args.output_prefix + '_stats_approximate.csv')
+    else: 
+        df.to_csv(args.output_prefix + '_stats.csv')
+
+if __name__ == '__main__': 
+    main()
@@ -23,7 +23,7 @@ def main():
     nlp = spacy.load('en_core_web_trf', exclude=["transformer", "ner", "tagger", "parser", "attribute_ruler", "lemmatizer"])
     nlp.add_pipe('sentencizer')
     
-    books = get_book_txts(args.input_dir, splitlines=True)
+    books = Corpus(args.input_dir)
     book_id = 0
     sent_id = 0
     
@@ -34,7 +34,7 @@ def main():
         
         for title, textbook_lines in books.items():
             print(title)
-            for line in tqdm(textbook_lines):
+            for line in tqdm(textbook_lines, total=books.num_lines(title)):
                 doc = nlp(line, disable=["transformer", "ner", "tagger", "parser", "attribute_ruler", "lemmatizer"])
                 for sent in doc.sents: 
                     d = {}
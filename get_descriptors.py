@@ -7,104 +7,149 @@ Added "chunk_size" variable to adjust for books where each line is very long.
 
 import argparse
 from helpers import *
-import spacy
+from lexicon import TermMatcher, TermPrefilter
+from parse_cache import load_parser, load_sentencizer, count_sentences
+from checkpoint import Checkpoint, flush_output, truncate_output
 import os
-import math
+import itertools
+import multiprocessing
+import shutil
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_dir', required=True)
 parser.add_argument('--output_prefix', required=True)
 parser.add_argument('--people_terms', required=True)
+parser.add_argument('--parse_cache', help="Folder of en_core_web_trf parses shared across scripts (see parse_cache.py).")
+parser.add_argument('--prefilter', action='store_true', help="Skip parsing chunks without a people term, and only "
+                                                             "count their sentences with a sentencizer to move token_ID on.")
+parser.add_argument('--audit_rate', default=0.0, type=float, help="Fraction of books to also run without --prefilter, "
+                                                                  "to check that the output is the same.")
+parser.add_argument('--resume', action='store_true', help="Skip books finished before a crashed run stopped.")
+parser.add_argument('--chunk_chars', type=int, help="Parse each line as its own Doc, batched in chunks of up to this "
+                                                     "many characters, instead of 1000 (or 10) lines at a time as one Doc.")
+parser.add_argument('--chunk_tokens', type=int, help="Like --chunk_chars, but a budget of whitespace-separated tokens. "
+                                                      "Both can be given.")
+parser.add_argument('--batch_size', default=4, type=int, help="Fixed chunks per nlp.pipe batch. With --chunk_chars "
+                                                               "or --chunk_tokens each chunk is one batch.")
+parser.add_argument('--num_workers', default=1, type=int, help="Processes parsing whole books at once, "
+                                                                 "each loading its own copy of the model.")
 
 args = parser.parse_args()
 
-def run_depparse(people, aapi_term_dict, textbook_lines, title, nlp): 
+def get_descriptor_rows(doc, people, aapi_matcher, title, j): 
+    '''
+    Rows for the noun chunks in @doc whose head is a person, numbering
+    chunks on from @j. Returns the rows and the last chunk number. 
+    '''
+    res = []
+    for chunk in doc.noun_chunks: 
+        j += 1
+        noun_phrase = chunk.text.lower()
+        head_token = chunk.root.text.lower()
+        
+        # check that head of noun is a person
+        if head_token in people:
+            target_term = chunk.root.head.text.lower()
+            dem = 'other'
+            
+            # check if noun chunk is aapi
+            noun_tokens = [tok.text.lower() for tok in chunk]
+            if aapi_matcher.matches(noun_tokens, use_rules='online' not in args.output_prefix): 
+                dem = 'aapi'
+            
+            if chunk.root.dep_ == 'nsubj' and (chunk.root.head.pos_ == 'VERB'): 
+                res.append((str(j), title, noun_phrase, dem, target_term, chunk.root.head.pos_, chunk.root.dep_))
+            
+            if chunk.root.dep_ == 'nsubjpass' and chunk.root.head.pos_ == 'VERB': 
+                res.append((str(j), title, noun_phrase, dem, target_term, chunk.root.head.pos_, chunk.root.dep_))
+            
+            if (chunk.root.dep_ == 'obj' or chunk.root.dep_ == 'dobj') and chunk.root.head.pos_ == 'VERB': 
+                res.append((str(j), title, noun_phrase, dem, target_term, chunk.root.head.pos_, chunk.root.dep_))
+    return res, j
+
+def keep_chunk(lines, prefilter): 
+    '''
+    Whether to parse a chunk of @lines, which is only skipped when 
+    @prefilter rejects the whole chunk, so every line in it. 
+    '''
+    if prefilter is None: 
+        return True
+    return prefilter.check('\n'.join(lines), audit=False)[0]
+
+def fixed_chunk_size(num_lines): 
+    if num_lines < 1000: 
+        # this is a book where lines may be long
+        return 10
+    return 1000
+
+def fixed_chunks(textbook_lines, num_lines): 
+    '''
+    Break up every textbook into 1000 line chunks to avoid spaCy's text 
+    length limit, or 10 line chunks for books where lines may be long. 
+    '''
+    chunk_size = fixed_chunk_size(num_lines)
+    textbook_lines = iter(textbook_lines)
+    for i in range(0, num_lines, chunk_size):
+        yield list(itertools.islice(textbook_lines, chunk_size))
+
+def run_depparse(people, aapi_matcher, textbook_lines, num_lines, title, nlp, prefilter=None, sentencizer=None): 
     '''
     Get adjectives and verbs associated with frequent named entities
     and common nouns referring to people.
     @inputs: 
-    - possible_marks: words that may mark common nouns with a social group, e.g. "black"
-    - word2dem: word to demographic category
-    - textbook_lines: strings of textbook content in a list
+    - people: words that refer to people
+    - aapi_matcher: lexicon.TermMatcher for AAPI terms
+    - textbook_lines: iterable of textbook lines, e.g. Corpus.lines(title)
+    - num_lines: number of lines in the book
     - title: title of book
     - outfile: opened file
-    - nlp: spacy pipeline
+    - nlp: spacy pipeline or parse_cache.ParseCache
+    - prefilter: optional lexicon.TermPrefilter, see keep_chunk()
+    - sentencizer: counts the sentences of skipped chunks, see parse_cache.load_sentencizer()
+    Lines are parsed in fixed_chunks(), each as one '\n'-joined Doc, or with 
+    --chunk_chars or --chunk_tokens one Doc per line, batched in chunks 
+    packed up to that size by chunk_lines(). 
     '''
     print("Running dependency parsing for", title)
-    # Break up every textbook into 2k line chunks to avoid spaCy's text length limit 
+    num_parts = None
+    if args.chunk_chars is None and args.chunk_tokens is None: 
+        chunk_size = fixed_chunk_size(num_lines)
+        num_parts = (num_lines + chunk_size - 1) // chunk_size
+        # each chunk is parsed as one Doc
+        chunks = (['\n'.join(lines)] if lines else [] for lines in fixed_chunks(textbook_lines, num_lines))
+    else: 
+        chunks = chunk_lines(textbook_lines, max_chars=args.chunk_chars, max_tokens=args.chunk_tokens)
+    # (part, texts of its Docs, whether to parse them), 
+    # parts are numbered before empty ones are dropped
+    chunks = ((k, texts, keep_chunk(texts, prefilter)) for k, texts in enumerate(chunks, 1) if texts)
+    parts, chunks = itertools.tee(chunks)
+    chunks = (texts for _, texts, parse in chunks if parse)
+    if num_parts is None: 
+        # a sentence never spans two lines, see pipe_chunks()
+        docs = (doc for chunk_docs in pipe_chunks(nlp, chunks) for doc in chunk_docs)
+    else: 
+        docs = nlp.pipe((texts[0] for texts in chunks), batch_size=args.batch_size)
+    # noun chunks are numbered across the whole book
     j = 0
-    k = 0
-    num_lines = len(textbook_lines)
-    chunk_size = 1000
-    if num_lines < 1000: 
-        # this is a book where lines may be long
-        chunk_size = 10
     res = []
-    for i in range(0, num_lines, chunk_size):
-        chunk = '\n'.join(textbook_lines[i:i+chunk_size])
-        doc = nlp(chunk)
-        k += 1
-        print("Finished part", k, "of", math.ceil(num_lines/chunk_size))
-        
-        for chunk in doc.noun_chunks: 
-            j += 1
-            noun_phrase = chunk.text.lower()
-            head_token = chunk.root.text.lower()
-            
-            # check that head of noun is a person
-            if head_token in people:
-                target_term = chunk.root.head.text.lower()
-                noun_tokens = set(noun_phrase.split())
-                dem = 'other'
-                
-                # check if noun chunk is aapi
-                for term_length in aapi_term_dict: 
-                    if term_length == 1: 
-                        # unigram
-                        unigram_terms = set(aapi_term_dict[term_length])
-                        overlap = unigram_terms & noun_tokens
-                        if overlap: 
-                            dem = 'aapi'
-                        # indian edge case
-                        if 'online' not in args.output_prefix and \
-                            ('indian' in overlap or 'indians' in overlap) and \
-                            'asian' not in set(noun_tokens): 
-                            dem = 'other'
-                    else: 
-                        # bigram or trigram
-                        for term in aapi_term_dict[term_length]: 
-                            if term in noun_phrase: 
-                                dem = 'aapi'
-                                break
-                    if dem == 'aapi': break
-                
-                if chunk.root.dep_ == 'nsubj' and (chunk.root.head.pos_ == 'VERB'): 
-                    res.append((str(j), title, noun_phrase, dem, target_term, chunk.root.head.pos_, chunk.root.dep_))
-                
-                if chunk.root.dep_ == 'nsubjpass' and chunk.root.head.pos_ == 'VERB': 
-                    res.append((str(j), title, noun_phrase, dem, target_term, chunk.root.head.pos_, chunk.root.dep_))
-                
-                if (chunk.root.dep_ == 'obj' or chunk.root.dep_ == 'dobj') and chunk.root.head.pos_ == 'VERB': 
-                    res.append((str(j), title, noun_phrase, dem, target_term, chunk.root.head.pos_, chunk.root.dep_))
-                    
+    for k, texts, parse in parts: 
+        for text in texts: 
+            if parse: 
+                rows, j = get_descriptor_rows(next(docs), people, aapi_matcher, title, j)
+                res.extend(rows)
+            else: 
+                # noun chunks need the parser, so j moves on by the sentences
+                j += count_sentences(sentencizer, text)
+        if num_parts is None: 
+            print("Finished part", k)
+        else: 
+            print("Finished part", k, "of", num_parts)
     return res
 
-def main(): 
-    aapi_terms, other_terms = get_people_terms(args.people_terms)
-    # load spacy
-    nlp = spacy.load("en_core_web_trf")
-    aapi_term_dict = get_aapi_term_dict(aapi_terms, nlp)
-    # load books
-    books = get_book_txts(args.input_dir, splitlines=True)
-    res = []
-    people = aapi_terms | other_terms
-    for title, textbook_lines in books.items():
-        res.extend(run_depparse(people, aapi_term_dict, textbook_lines, title, nlp))
-    outfile = codecs.open(args.output_prefix + '_people_descriptors.csv', 'w', encoding='utf-8')
-    fieldnames = ['token_ID', 'filename', 'entity', 'category', 'word', 'POS', 'rel']
-    writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-    writer.writeheader()
+FIELDNAMES = ['token_ID', 'filename', 'entity', 'category', 'word', 'POS', 'rel']
+
+def write_rows(writer, res): 
     for tup in res: 
         if type(tup[3]) == list or type(tup[3]) == set: 
             for d in tup[3]: 
@@ -127,7 +172,120 @@ def main():
                             'rel': tup[6]
                             }
             writer.writerow(out_dict)
+
+# model and lookups of this process, loaded once by init_worker()
+worker = {}
+
+def init_worker(): 
+    '''
+    Loads the model and people terms, once in every worker process. 
+    '''
+    if args.num_workers > 1: 
+        import torch
+        # otherwise every worker tries to use all of the cores
+        torch.set_num_threads(max(1, os.cpu_count() // args.num_workers))
+    aapi_terms, other_terms = get_people_terms(args.people_terms)
+    worker['people'] = aapi_terms | other_terms
+    worker['nlp'] = load_parser(args.parse_cache)
+    worker['sentencizer'] = load_sentencizer() if args.prefilter else None
+    worker['aapi_matcher'] = TermMatcher.from_people_terms(args.people_terms)
+    worker['books'] = Corpus(args.input_dir)
+
+def parts_dir(): 
+    return args.output_prefix + '_people_descriptors.parts'
+
+def part_path(title): 
+    return os.path.join(parts_dir(), title + '.csv')
+
+def parse_book(title): 
+    '''
+    Writes the rows of one book, without a header, to its part file. The
+    part file only appears once the book is done. Returns the title and
+    the prefilter counts for the book, if there is a prefilter. 
+    '''
+    nlp, people, books = worker['nlp'], worker['people'], worker['books']
+    prefilter = None
+    if args.prefilter: 
+        # seeded by title, so which books are audited does not depend on the workers
+        prefilter = TermPrefilter([people], audit_rate=args.audit_rate, seed=title, audit_unit='books')
+    res = run_depparse(people, worker['aapi_matcher'], books.lines(title), books.num_lines(title), title, nlp, 
+                       prefilter=prefilter, sentencizer=worker['sentencizer'])
+    if prefilter is not None and prefilter.sample_audit(): 
+        # the whole book again without the prefilter
+        audit_res = run_depparse(people, worker['aapi_matcher'], books.lines(title), books.num_lines(title), title, nlp)
+        prefilter.record_audit(audit_res == res)
+    part_file = part_path(title)
+    with codecs.open(part_file + '.tmp', 'w', encoding='utf-8') as outfile: 
+        writer = csv.DictWriter(outfile, fieldnames=FIELDNAMES)
+        write_rows(writer, res)
+    os.replace(part_file + '.tmp', part_file)
+    nlp.flush()
+    return title, (prefilter.counts() if prefilter is not None else None)
+
+def map_books(titles): 
+    '''
+    Runs parse_book on each title, on a process pool if num_workers > 1. 
+    Yields the results as books finish. 
+    '''
+    if args.num_workers <= 1: 
+        init_worker()
+        for title in titles: 
+            yield parse_book(title)
+        return
+    # longest books first, so one is not left running at the end
+    books = Corpus(args.input_dir)
+    titles = sorted(titles, key=lambda title: -os.path.getsize(books.files[title]))
+    with multiprocessing.Pool(args.num_workers, initializer=init_worker) as pool: 
+        for result in pool.imap_unordered(parse_book, titles): 
+            yield result
+
+def main(): 
+    books = Corpus(args.input_dir)
+    output_file = args.output_prefix + '_people_descriptors.csv'
+    # the checkpoint has the books merged into output_file and its size after them
+    checkpoint = Checkpoint(output_file + '.checkpoint', resume=args.resume, 
+                            config={'input_dir': os.path.abspath(args.input_dir), 'prefilter': args.prefilter, 
+                                    'chunk_chars': args.chunk_chars, 'chunk_tokens': args.chunk_tokens})
+    done_books = checkpoint.get('books', [])
+    if checkpoint.resumed: 
+        truncate_output(output_file, checkpoint.get('bytes'))
+        print("Resuming after", len(done_books), "books")
+    elif os.path.exists(parts_dir()): 
+        shutil.rmtree(parts_dir())
+    os.makedirs(parts_dir(), exist_ok=True)
+    outfile = codecs.open(output_file, 'a' if checkpoint.resumed else 'w', encoding='utf-8')
+    if not checkpoint.resumed: 
+        csv.DictWriter(outfile, fieldnames=FIELDNAMES).writeheader()
+    
+    # books are parsed in any order, but merged in title order, 
+    # so output_file is the same whatever the number of workers
+    to_merge = [title for title in books.titles() if title not in done_books]
+    # parts finished before a crash are not parsed again
+    parsed = [title for title in to_merge if os.path.exists(part_path(title))]
+    results = itertools.chain(((title, None) for title in parsed), 
+                              map_books([title for title in to_merge if title not in parsed]))
+    finished = set()
+    prefilter = None
+    if args.prefilter: 
+        # only adds up the counts of the workers' prefilters
+        prefilter = TermPrefilter([], audit_unit='books')
+    for title, counts in results: 
+        finished.add(title)
+        if counts is not None: 
+            prefilter.add_counts(counts)
+        while to_merge and to_merge[0] in finished: 
+            next_title = to_merge.pop(0)
+            with codecs.open(part_path(next_title), 'r', encoding='utf-8') as infile: 
+                shutil.copyfileobj(infile, outfile)
+            flush_output(outfile)
+            done_books.append(next_title)
+            checkpoint.commit(books=done_books, bytes=os.path.getsize(output_file))
+            os.remove(part_path(next_title))
     outfile.close()
+    shutil.rmtree(parts_dir())
+    checkpoint.finish()
+    if prefilter is not None: 
+        print(prefilter.summary())
 
 if __name__ == '__main__':
     main()
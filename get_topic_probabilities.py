@@ -2,10 +2,21 @@
 Get topic probability of sentences containing 
 
 python get_topic_probabilities.py --sentence_file ./logs/combined_coref_data.csv --topic_dir ./topics/topics_50/ --people_terms wordlists/people_terms.csv --output_file ./logs/combined_coref_data_topics_50.csv
+
+With --output_file ./logs/combined_coref_data_topics_50.parquet the table is columnar, read it with sentence_topics.load_sentence_topics. 
+
+A csv output is checkpointed after every chunk, and after a crash the same command with --resume carries on from the last checkpoint. 
 '''
 import numpy as np
 import argparse
 from helpers import *
+from lexicon import TermMatcher, TermPrefilter
+from parse_cache import load_parser
+from checkpoint import Checkpoint, truncate_output
+from topic_models import load_doc_topic_matrix, load_doc_index, lookup_doc_rows
+from sentence_topics import SentenceTopicWriter, get_table_format
+import itertools
+import time
 import csv
 from tqdm import tqdm
 import torch
@@ -16,10 +27,42 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--sentence_file', required=True)
 parser.add_argument('--topic_dir', required=True)
 parser.add_argument('--people_terms', required=True)
-parser.add_argument('--output_file', required=True)
+parser.add_argument('--output_file', required=True, help="csv, or a .parquet or .arrow file for a columnar table "
+                                                        "(see sentence_topics.SentenceTopicWriter).")
+parser.add_argument('--batch_size', default=64, type=int, help="Sentences per nlp.pipe batch.")
+parser.add_argument('--chunk_size', default=10000, type=int, help="Csv rows read and written at a time.")
+parser.add_argument('--parse_cache', help="Folder of en_core_web_trf parses shared across scripts (see parse_cache.py).")
+parser.add_argument('--prefilter', action='store_true', help="Skip parsing sentences without both a people term "
+                                                             "and an aapi term, which cannot have aapi noun chunks.")
+parser.add_argument('--audit_rate', default=0.0, type=float, help="Fraction of prefiltered sentences to parse anyway "
+                                                                  "to check that their output is the same.")
+parser.add_argument('--resume', action='store_true', help="Carry on from the checkpoint of a crashed run "
+                                                          "(csv output only).")
 
 args = parser.parse_args()
 
+def get_aapi_terms(doc, sentence, people, aapi_matcher, use_rules=True): 
+    terms = set()
+    # check if there are aapi people in sentence
+    for chunk in doc.noun_chunks: 
+        head_token = chunk.root.text.lower()
+        if head_token in people:
+            noun_tokens = [tok.text.lower() for tok in chunk]
+            for term in aapi_matcher.terms_in(noun_tokens, use_rules=False): 
+                # edge case where "Indian" in textbooks
+                # does not usually refer to Indians from Asia
+                if use_rules and term.startswith('indian') and 'Asian ' + term.title() not in sentence: 
+                    continue
+                terms.add(term)
+    return terms
+
+def read_chunks(reader, chunk_size): 
+    while True: 
+        rows = list(itertools.islice(reader, chunk_size))
+        if not rows: 
+            return
+        yield rows
+
 def main(): 
     '''
     Sentence order follows the order in sentence_file. 
@@ -31,81 +74,110 @@ def main():
     
     spacy.require_gpu()
     
-    doc_topic_file = '%sdoc-topics.gz' % args.topic_dir
-    doc_topics = open(doc_topic_file).read().splitlines() # list of topics
+    doc_topic_file = os.path.join(args.topic_dir, 'doc-topics.gz')
     
     print("Getting doc topic matrix...")
-    doc_topics_matrix = [] # doc x topics
-    for i, doc in enumerate(doc_topics): 
-        contents = doc.split('\t')
-        topics = [float(i) for i in contents[2:]]
-        doc_topics_matrix.append(topics)
-    doc_topics_matrix = np.array(doc_topics_matrix)
+    # memory-mapped doc x topics, if get_topics.py wrote doc-topics.npy
+    doc_topics_matrix = load_doc_topic_matrix(doc_topic_file)
+    num_topics = doc_topics_matrix.shape[1]
+    
+    # only noun chunks are used, which need the tagger and parser
+    parse_cache = load_parser(args.parse_cache, exclude=["ner", "lemmatizer"])
     
-    nlp = spacy.load('en_core_web_trf')
+    # the "indian" rule is checked against the sentence text in get_aapi_terms
+    aapi_matcher = TermMatcher.from_people_terms(args.people_terms, rules=[])
+    prefilter = None
+    if args.prefilter: 
+        prefilter = TermPrefilter.from_people_terms(args.people_terms, views=('people', 'aapi_terms'), 
+                                                    audit_rate=args.audit_rate)
     
-    aapi_term_dict = get_aapi_term_dict(aapi_terms, nlp)
+    # doc-topics row of each (state, sentence_id), -1 if get_topics.py dropped it
+    doc_index = load_doc_index(args.topic_dir)
     
     print("Reading in lines...")
     num_lines = 874127 # hardcoded, calculated using wc -l on sentence_file
-    with open(args.output_file, 'w', encoding='utf-8') as csvfile:
-        fieldnames = ['state', 'book_id', 'book_filename', 'subject', 'sentence_id', 'sentence', 'aapi']
-        for i in range(doc_topics_matrix.shape[1]): 
-            fieldnames.append('topic_' + str(i))
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        
+    num_parsed = 0
+    start = time.perf_counter()
+    fieldnames = ['state', 'book_id', 'book_filename', 'subject', 'sentence_id', 'sentence', 'aapi']
+    for i in range(num_topics): 
+        fieldnames.append('topic_' + str(i))
+    # rows of sentence_file done and size of output_file after them
+    checkpoint = None
+    if get_table_format(args.output_file) == 'csv': 
+        checkpoint = Checkpoint(args.output_file + '.checkpoint', resume=args.resume, 
+                                config={'sentence_file': os.path.abspath(args.sentence_file), 
+                                        'topic_dir': os.path.abspath(args.topic_dir)})
+    elif args.resume: 
+        raise ValueError("--resume needs a csv output_file")
+    num_done = 0
+    if checkpoint is not None and checkpoint.resumed: 
+        num_done = checkpoint.get('rows')
+        truncate_output(args.output_file, checkpoint.get('bytes'))
+        print("Resuming after", num_done, "rows")
+    with SentenceTopicWriter(args.output_file, fieldnames, append=num_done > 0) as writer: 
         with open(args.sentence_file, 'r', encoding='utf-8') as infile: 
             reader = csv.DictReader(infile)
-            sent_num = 0
-            for row in tqdm(reader, total=num_lines): 
-                sent = row['sentence'] 
-                tokens = clean_text(sent,
-                                 stem=False,
-                                 remove_short=True,
-                                 remove_stopwords=True, 
-                                 round_dates=True)
-                if len(tokens) < 5: 
-                    for i in range(doc_topics_matrix.shape[1]): 
-                        row['topic_' + str(i)] = ''
-                    row['aapi'] = ''
-                    writer.writerow(row)
-                    continue
-
-                doc = nlp(sent)
+            # finished rows are read but not parsed again
+            for row in itertools.islice(reader, num_done): 
+                pass
+            pbar = tqdm(total=num_lines, initial=num_done)
+            for rows in read_chunks(reader, args.chunk_size): 
+                doc_rows = lookup_doc_rows(doc_index, [row['state'] for row in rows], 
+                                           [int(row['sentence_id']) for row in rows])
+                # sentences that were not topic modeled are not parsed
+                to_parse = []
+                audited = set()
+                aapi = {}
+                for i, sent_num in enumerate(doc_rows): 
+                    if sent_num < 0: 
+                        continue
+                    if prefilter is not None: 
+                        parse, audit = prefilter.check(rows[i]['sentence'])
+                        if not parse: 
+                            aapi[i] = ''
+                            continue
+                        if audit: 
+                            audited.add(i)
+                    to_parse.append(i)
+                docs = parse_cache.pipe((rows[i]['sentence'] for i in to_parse), batch_size=args.batch_size)
+                for i, doc in zip(to_parse, docs): 
+                    terms = get_aapi_terms(doc, rows[i]['sentence'], people, aapi_matcher, 
+                                           use_rules=rows[i]['state'] != 'Online')
+                    aapi[i] = ', '.join(terms)
+                    if i in audited: 
+                        prefilter.record_audit(aapi[i] == '')
+                num_parsed += len(to_parse)
                 
-                terms = set()
-                # check if there are aapi people in sentence
-                for chunk in doc.noun_chunks: 
-                    noun_phrase = chunk.text.lower()
-                    head_token = chunk.root.text.lower()
-                    if head_token in people:
-                        noun_tokens = set(noun_phrase.split())
-                        for term_length in aapi_term_dict: 
-                            if term_length == 1: 
-                                # unigram
-                                unigram_terms = set(aapi_term_dict[term_length])
-                                overlap = unigram_terms & noun_tokens
-                                for term in overlap: 
-                                    # edge case where "Indian" in textbooks
-                                    # does not usually refer to Indians from Asia
-                                    if row['state'] != 'Online' and \
-                                    term.startswith('indian') and 'Asian ' + term.title() not in sent: 
-                                        continue
-                                    terms.add(term)
-                            else: 
-                                # bigram or trigram
-                                for term in aapi_term_dict[term_length]: 
-                                    if term in noun_phrase: 
-                                        terms.add(term)
-                if terms: 
-                    row['aapi'] = ', '.join(terms)
-                else: 
-                    row['aapi'] = ''
-                for i in range(doc_topics_matrix.shape[1]): 
-                    row['topic_' + str(i)] = round(doc_topics_matrix[sent_num][i], 5)
-                writer.writerow(row)
-                sent_num += 1
+                # rows are written in input order
+                topics = doc_topics_matrix[np.maximum(doc_rows, 0)]
+                for i, row in enumerate(rows): 
+                    if doc_rows[i] < 0: 
+                        row['aapi'] = ''
+                        for k in range(num_topics): 
+                            row['topic_' + str(k)] = ''
+                    else: 
+                        row['aapi'] = aapi[i]
+                        for k in range(num_topics): 
+                            row['topic_' + str(k)] = round(float(topics[i, k]), 5)
+                writer.write_rows(rows)
+                num_done += len(rows)
+                if checkpoint is not None: 
+                    writer.flush()
+                    checkpoint.commit(rows=num_done, bytes=os.path.getsize(args.output_file))
+                pbar.update(len(rows))
+                elapsed = time.perf_counter() - start
+                pbar.set_postfix(sents_per_sec='%.1f' % (num_parsed / elapsed))
+            pbar.close()
+    if checkpoint is not None: 
+        checkpoint.finish()
+    elapsed = time.perf_counter() - start
+    print("Parsed %d sentences in %.1f sec (%.1f sentences/sec, batch size %d)" % 
+          (num_parsed, elapsed, num_parsed / max(elapsed, 1e-9), args.batch_size))
+    parse_cache.close()
+    if prefilter is not None: 
+        print(prefilter.summary())
+    if args.parse_cache: 
+        print(parse_cache.summary())
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
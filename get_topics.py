@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Author: Dora Demszky (ddemszky@stanford.edu), based on <cite: Chenhao>
-import functools
 import argparse
 import json
 import logging
@@ -9,94 +8,168 @@ from helpers import *
 from nltk import *
 import itertools
 import numpy as np
+from scipy import sparse
 from collections import Counter, defaultdict
 import io
 import csv
+import multiprocessing
+import hashlib
+import shutil
+import time
+import concurrent.futures
+from array import array
+from topic_models import GibbsBackend, MalletBackend, \
+    load_doc_topic_matrix, save_doc_topic_matrix, save_book_offsets, save_doc_index, load_topic_word_ids, \
+    umass_coherence
+from token_corpus import TokenCorpus, TokenCorpusBuilder
 
 logging.basicConfig(level=logging.INFO)
 
+# bump when preprocessing changes so old cache entries are not reused
+PREPROCESS_VERSION = 3
+
+# columns preprocess() reads from input_file
+INPUT_COLUMNS = ['state', 'sentence_id', 'book_filename', 'sentence']
+
+PREPROCESS_FILES = ['bigram_phrases.txt', 'data.word_id.dict', 'data.input', 'doc_terms.npz',
+                    'corpus.tokens.npy', 'corpus.offsets.npy', 'corpus.book_ids.npy', 'corpus.vocab.json', 'doc_index.npz']
+
 parser = argparse.ArgumentParser()
-parser.add_argument('--input_file', required=True, help="csv file containing sentences under the 'sentence' column and book names under 'book_filename' column.")
+parser.add_argument('--input_file', required=True, help="csv file containing sentences under the 'sentence' column, book names under 'book_filename' column, "
+                                                         "and 'state' and integer 'sentence_id' columns that key each row in doc_index.npz.")
 parser.add_argument('--people_terms', required=True)
 parser.add_argument("--output_dir",
                     help=("output directory for intermediate data"),
                     type=str)
-parser.add_argument('--mallet_dir', required=True, help="Location of MALLET binary file.")
-parser.add_argument('--num_topics', default=100, type=int, help="Number of topics to induce.")
+parser.add_argument('--mallet_dir', help="Location of MALLET binary file.")
+parser.add_argument('--backend', default='mallet', choices=['mallet', 'gibbs'],
+                    help="Train with MALLET or the in-process Gibbs sampler in topic_models.py.")
+parser.add_argument('--iterations', default=1000, type=int, help="Sampling iterations for the gibbs backend.")
+parser.add_argument('--num_topics', default='100', help="Number of topics to induce. A comma-separated list, "
+                                                         "e.g. 25,50,75,100, trains one model per K under "
+                                                         "output_dir/topics_K and writes output_dir/sweep.csv.")
+parser.add_argument('--sweep_workers', default=2, type=int, help="Number of models to train at once in a sweep.")
+parser.add_argument('--num_workers', default=1, type=int, help="Number of processes for cleaning sentences.")
+parser.add_argument('--cache_dir', help="Where to cache preprocessed inputs shared across runs "
+                                          "(default: .topic_cache next to output_dir).")
 parser.add_argument('--stem', action='store_true', help="Whether to stem words before running the topic model "
                                                         "(in the paper, we do).")
 
 args = parser.parse_args()
 aa_terms, _ = get_people_terms(args.people_terms)
 
-def generate_cooccurrence_from_int_set(articles, num_topics=100):
-    matrix = np.zeros((num_topics, num_topics))
-    for topics in articles:
-        for topic in topics:
-            matrix[topic, topic] += 1
-        for (i, j) in itertools.combinations(topics, 2):
-            matrix[i, j] += 1
-            matrix[j, i] += 1
-    return matrix
-
-def find_bigrams(sentences, output_file, threshold=100, min_count=5):
-    unigram_count = get_word_count(sentences, ngrams=1, words_func=get_ngram_list)
-    total_words = float(sum(unigram_count.values()))
-    bigram_count = get_word_count(sentences, ngrams=2, words_func=get_ngram_list)
-
-    bigram_list = []
-    for w in bigram_count:
-        words = w.split()
-        score = (bigram_count[w] - min_count) * total_words \
-                / (unigram_count[words[0]] * unigram_count[words[1]])
-        if score > threshold:
-            bigram_list.append((score, w))
+def generate_cooccurrence(indicators):
+    '''
+    @indicators: sparse docs x topics 0/1 matrix (see get_topic_indicators)
+    Returns the topics x topics matrix where the diagonal counts the docs
+    with each topic, and off-diagonal entries count docs with both topics. 
+    '''
+    return np.asarray((indicators.T @ indicators).todense(), dtype=np.float64)
+
+def get_book_cooccurrences(indicators, book_lengths):
+    '''
+    Co-occurrence matrix for each run of rows in @indicators, 
+    where book_lengths are the number of docs in each book in row order. 
+    Returns a books x topics x topics array. 
+    '''
+    num_topics = indicators.shape[1]
+    result = np.zeros((len(book_lengths), num_topics, num_topics))
+    prev = 0
+    for b, length in enumerate(book_lengths):
+        result[b] = generate_cooccurrence(indicators[prev:prev + length])
+        prev += length
+    return result
+
+def get_aa_mask(vocab):
+    """True for every token id that is a term referring to Asians"""
+    return np.array([w in aa_terms for w in vocab], dtype=bool)
+
+
+def get_pair_keys(first, second, vocab_size):
+    """Hashes pairs of token ids into single int64 keys"""
+    return np.asarray(first, dtype=np.int64) * vocab_size + second
+
+
+def get_aa_bigram_keys(vocab):
+    """Pair keys of the two-word terms referring to Asians"""
+    word2id = {w: i for i, w in enumerate(vocab)}
+    pairs = [t.split() for t in aa_terms if len(t.split()) == 2]
+    pairs = [(word2id[a], word2id[b]) for a, b in pairs if a in word2id and b in word2id]
+    return np.array([a * len(vocab) + b for a, b in pairs], dtype=np.int64)
+
+
+def get_word_count(corpus, ngrams=1):
+    """
+    Unigram counts as an array over corpus.vocab, or with ngrams=2, 
+    (pair keys, counts) of bigrams within sentences. 
+    """
+    tokens = np.asarray(corpus.tokens)
+    # We exclude unigrams and bigrams containing terms referring to Asians from topic modeling
+    aa_mask = get_aa_mask(corpus.vocab)
+    if ngrams == 1:
+        return np.bincount(tokens[~aa_mask[tokens]], minlength=len(corpus.vocab))
+    positions = corpus.pair_positions()
+    first = tokens[positions]
+    second = tokens[positions + 1]
+    keep = ~aa_mask[first] & ~aa_mask[second]
+    keys = get_pair_keys(first[keep], second[keep], len(corpus.vocab))
+    keys = keys[~np.isin(keys, get_aa_bigram_keys(corpus.vocab))]
+    return np.unique(keys, return_counts=True)
+
+
+def find_bigrams(corpus, output_file, threshold=100, min_count=5):
+    unigram_count = get_word_count(corpus, ngrams=1)
+    total_words = float(unigram_count.sum())
+    keys, bigram_count = get_word_count(corpus, ngrams=2)
+    first, second = np.divmod(keys, len(corpus.vocab))
+
+    scores = (bigram_count - min_count) * total_words \
+             / (unigram_count[first] * unigram_count[second])
+    bigram_list = [(float(scores[i]), corpus.vocab[first[i]] + " " + corpus.vocab[second[i]])
+                   for i in np.flatnonzero(scores > threshold)]
     bigram_list.sort(reverse=True)
     with open(output_file, "w") as fout:
         for score, w in bigram_list:
             fout.write("%s\n" % json.dumps({"word": w, "score": score}))
 
 
-def get_ngram_list(input_words, ngrams=1, bigram_dict=None):
-    words = [w.lower() for w in input_words.split()]
-    result = []
-    for start in range(len(words) - ngrams + 1):
-        tmp_words = words[start:start + ngrams]
-        # We exclude bigrams containing terms referring to Asians from topic modeling
-        if set(tmp_words) & aa_terms: continue 
-        w = " ".join(tmp_words)
-        if w in aa_terms: continue 
-        result.append(w)
-    return result
-
-
-def get_mixed_tokens(input_words, ngrams=1, bigram_dict=None):
-    words = [w.lower() for w in input_words.split()]
-    result, index = [], 0
-    while index < len(words):
-        w = words[index]
-        # look forward
-        if index < len(words) - 1:
-            bigram = w + " " + words[index + 1]
-            if bigram in bigram_dict:
-                # bigrams containing Asian terms already filtered in get_ngram_list
-                result.append(bigram)
-                index += 2
-                continue
-        # We exclude unigrams containing terms referring to Asians from topic modeling
-        if w not in aa_terms: 
-            result.append(w)
-        index += 1
-    return result
-
-
-def get_word_count(sentences, ngrams=1, bigram_dict=None, words_func=None):
-    result = defaultdict(int)
-    for sent in sentences:
-        words = words_func(sent, ngrams=ngrams, bigram_dict=bigram_dict)
-        for w in words:
-            result[w] += 1
-    return result
+def get_mixed_tokens(corpus, bigram_dict):
+    """
+    Merges the bigrams in bigram_dict into single tokens, left to right, 
+    and drops terms referring to Asians. Returns a TokenCorpus whose vocab 
+    is corpus.vocab followed by the bigrams. 
+    """
+    tokens = np.asarray(corpus.tokens)
+    vocab_size = len(corpus.vocab)
+    word2id = {w: i for i, w in enumerate(corpus.vocab)}
+    bigrams = [w.split() for w in bigram_dict]
+    bigram_keys = np.unique([word2id[a] * vocab_size + word2id[b] for a, b in bigrams
+                             if a in word2id and b in word2id]).astype(np.int64)
+
+    positions = corpus.pair_positions()
+    keys = get_pair_keys(tokens[positions], tokens[positions + 1], vocab_size)
+    starts_bigram = np.zeros(len(tokens), dtype=bool)
+    starts_bigram[positions[np.isin(keys, bigram_keys)]] = True
+    # in a run of overlapping bigrams, scanning left to right merges every 
+    # other one starting from the first
+    index = np.arange(len(tokens))
+    run_start = np.maximum.accumulate(np.where(
+        starts_bigram & ~np.r_[False, starts_bigram[:-1]], index, 0))
+    merged = starts_bigram & ((index - run_start) % 2 == 0)
+    consumed = np.r_[False, merged[:-1]]
+    # bigrams containing Asian terms already filtered in find_bigrams
+    emit = merged | (~consumed & ~get_aa_mask(corpus.vocab)[tokens])
+
+    positions = np.flatnonzero(emit)
+    mixed = tokens[positions].astype(np.int32)
+    is_bigram = merged[positions]
+    keys = get_pair_keys(tokens[positions[is_bigram]], tokens[positions[is_bigram] + 1], vocab_size)
+    mixed[is_bigram] = vocab_size + np.searchsorted(bigram_keys, keys)
+    bigram_words = [corpus.vocab[k // vocab_size] + " " + corpus.vocab[k % vocab_size]
+                    for k in bigram_keys.tolist()]
+    offsets = np.searchsorted(corpus.sentence_of(positions), np.arange(len(corpus) + 1))
+    return TokenCorpus(mixed, offsets.astype(np.int64), corpus.book_ids,
+                       list(corpus.vocab) + bigram_words, corpus.books)
 
 
 def load_bigrams(filename):
@@ -108,7 +181,12 @@ def load_bigrams(filename):
     return bigram_dict
 
 
-def get_word_dict(word_count, top=10000, filter_regex=None):
+def get_word_dict(vocab, word_count, top=10000, filter_regex=None):
+    """
+    {word : new id} for the top most frequent words, 
+    where word_count is an array of counts over the ids of vocab. 
+    """
+    word_count = {vocab[i]: int(word_count[i]) for i in np.flatnonzero(word_count)}
     if filter_regex:
         word_count = {w: word_count[w] for w in word_count
                       if all([re.match(filter_regex, sw) for sw in w.split()])}
@@ -132,32 +210,39 @@ def write_word_dict(vocab_dict, word_count, filename):
             fout.write("%d\t%s\t%d\n" % (wid, reverse_dict[wid],
                 word_count[reverse_dict[wid]]))
 
-def convert_word_count_mallet(word_dict, sentences, output_file,
-                              words_func=None):
-    doc_id = 0
+def convert_word_count_mallet(word_dict, corpus, output_file):
+    """
+    Writes each sentence of corpus as a MALLET doc of sorted word ids. 
+    Returns the in-vocabulary word ids of every token (in text order) and 
+    the offset where each doc starts, for the other backends. 
+    """
+    lookup = np.full(len(corpus.vocab), -1, dtype=np.int64)
+    for i, w in enumerate(corpus.vocab):
+        lookup[i] = word_dict.get(w, -1)
+    word_ids = lookup[np.asarray(corpus.tokens)]
+    keep = word_ids >= 0
+    docs = corpus.sentence_of(np.flatnonzero(keep))
+    word_ids = word_ids[keep].astype(np.int32)
+    doc_starts = np.searchsorted(docs, np.arange(len(corpus) + 1)).astype(np.int64)
+    sorted_ids = word_ids[np.lexsort((word_ids, docs))].tolist()
     with open(output_file, "w") as fout:
-        for sent in sentences:
-            doc_id += 1
-            words = Counter(words_func(sent))
-            words = [(word_dict[w], words[w])
-                     for w in words if w in word_dict]
-            words.sort()
-            word_cnts = [" ".join([str(wid)] * cnt) for (wid, cnt) in words]
-            fout.write("%s %s\n" % (doc_id, " ".join(word_cnts)))
-
-def get_mallet_input_from_words(sentences, data_dir, vocab_size=10000):
+        for doc in range(len(corpus)):
+            words = sorted_ids[doc_starts[doc]:doc_starts[doc + 1]]
+            fout.write("%s %s\n" % (doc + 1, " ".join(map(str, words))))
+    return word_ids, doc_starts
+
+def get_mallet_input(corpus, data_dir, vocab_size=10000):
     bigram_file = "%s/bigram_phrases.txt" % data_dir
-    find_bigrams(sentences, bigram_file)
+    find_bigrams(corpus, bigram_file)
     bigram_dict = load_bigrams(bigram_file)
-    word_cnts = get_word_count(sentences, bigram_dict=bigram_dict, words_func=get_mixed_tokens)
-    vocab_dict = get_word_dict(word_cnts, top=vocab_size, filter_regex="\w\w+")
-    write_word_dict(vocab_dict, word_cnts,
+    docs = get_mixed_tokens(corpus, bigram_dict)
+    word_cnts = np.bincount(docs.tokens, minlength=len(docs.vocab))
+    vocab_dict = get_word_dict(docs.vocab, word_cnts, top=vocab_size, filter_regex="\w\w+")
+    write_word_dict(vocab_dict, dict(zip(docs.vocab, word_cnts.tolist())),
                           "%s/data.word_id.dict" % data_dir)
-    convert_word_count_mallet(vocab_dict, sentences,
-                              "%s/data.input" % data_dir,
-                              words_func=functools.partial(
-                                  get_mixed_tokens,
-                                  bigram_dict=bigram_dict))
+    word_ids, doc_starts = convert_word_count_mallet(vocab_dict, docs,
+                                                     "%s/data.input" % data_dir)
+    return vocab_dict, word_ids, doc_starts
 
 def read_word_dict(filename, vocab_size=-1):
     vocab_map = {}
@@ -186,19 +271,22 @@ def load_topic_words(vocab, input_file, top=10):
     return topic_map
 
 
+def get_topic_indicators(doc_topic_matrix, threshold):
+    """Sparse docs x topics matrix with 1 where a topic is above threshold"""
+    # compare at the matrix's precision, since doc-topics.npy is float32
+    threshold = np.asarray(threshold, dtype=doc_topic_matrix.dtype)
+    return sparse.csr_matrix(doc_topic_matrix > threshold, dtype=np.float64)
+
 def load_doc_topics(sentences, doc_topic_file, threshold):
-    """Load topics in each document"""
-    articles = []
-    with open(doc_topic_file) as tfin:
-        for _ in sentences:
-            topic_line = tfin.readline()
-            if not topic_line:
-                break
-            topics = topic_line.strip().split()[2:]
-            topics = set([i for (i, v) in enumerate(topics)
-                         if float(v) > threshold])
-            articles.append(topics)
-    return articles
+    """
+    Load topics in each document as a sparse indicator matrix. 
+    If threshold is a list of thresholds, the file is read once and 
+    a {threshold : indicator matrix} dict is returned. 
+    """
+    doc_topic_matrix = load_doc_topic_matrix(doc_topic_file, num_docs=len(sentences))
+    if isinstance(threshold, (list, tuple)):
+        return {t: get_topic_indicators(doc_topic_matrix, t) for t in threshold}
+    return get_topic_indicators(doc_topic_matrix, threshold)
 
 def load_articles(sentences, topic_dir, threshold):
     vocab_file = "%s/data.word_id.dict" % topic_dir
@@ -209,30 +297,66 @@ def load_articles(sentences, topic_dir, threshold):
     articles = load_doc_topics(sentences, doc_topic_file, threshold=threshold)
     return articles, vocab, topic_map
 
-def get_count_cooccur(articles, func=generate_cooccurrence_from_int_set):
+def get_count_cooccur(articles, func=generate_cooccurrence):
     cooccur = func(articles)
     count = np.diag(cooccur).copy()
     np.fill_diagonal(cooccur, 0)
     return {"count": count, "cooccur": cooccur,
-            "articles": len(articles)}
+            "articles": articles.shape[0]}
 
 def get_pmi(matrix, topic_count, total,
             num_topics=50,
-            add_one=1.0):
+            add_one=1.0,
+            normalized=False):
     result = matrix.copy()
-    for i in range(num_topics):
-        for j in range(i + 1, num_topics):
-            score = get_log_pmi(matrix[i, j],
-                                      topic_count[i], topic_count[j], total,
-                                      add_one=add_one)
-            if np.isnan(score):
-                score = 0
-            result[i, j] = score
-            result[j, i] = score
+    scores = get_pmi_scores(matrix[:num_topics, :num_topics],
+                            topic_count[:num_topics], total,
+                            add_one=add_one, normalized=normalized)
+    # the upper triangle is mirrored onto the lower one, the diagonal is kept
+    rows, cols = np.triu_indices(num_topics, 1)
+    result[rows, cols] = scores[rows, cols]
+    result[cols, rows] = scores[rows, cols]
     print('pmi')
     print(result[:10, :10])
     return result
 
+def get_book_pmis(matrices, topic_counts, totals,
+                  add_one=1.0,
+                  normalized=False):
+    '''
+    PMI for a stack of books in one call. 
+    @matrices: books x topics x topics co-occurrence counts
+    @topic_counts: books x topics
+    @totals: number of docs in each book
+    Returns books x topics x topics, with the input diagonal kept. 
+    '''
+    matrices = np.asarray(matrices, dtype=np.float64)
+    result = matrices.copy()
+    num_topics = matrices.shape[-1]
+    scores = get_pmi_scores(matrices, np.asarray(topic_counts, dtype=np.float64),
+                            totals, add_one=add_one, normalized=normalized)
+    rows, cols = np.triu_indices(num_topics, 1)
+    result[:, rows, cols] = scores[:, rows, cols]
+    result[:, cols, rows] = scores[:, rows, cols]
+    return result
+
+def get_pmi_scores(matrix, topic_count, total, add_one=1.0, normalized=False):
+    '''
+    get_log_pmi broadcast over a topics x topics matrix (or a stack of
+    them), with NaN scores set to 0. If normalized, returns NPMI, 
+    i.e. PMI divided by -log p(x, y). 
+    '''
+    total = np.asarray(total, dtype=np.float64)[..., None, None]
+    x = topic_count[..., :, None]
+    y = topic_count[..., None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = get_log_pmi(matrix, x, y, total, add_one=add_one)
+        if normalized:
+            add_one = max(add_one, 0)
+            scores = scores / (np.log(total + add_one) - np.log(matrix + add_one))
+    scores[np.isnan(scores)] = 0
+    return scores
+
 def get_log_pmi(xy, x, y, total, add_one=1.0):
     if add_one < 0:
         add_one = 0
@@ -253,53 +377,215 @@ def get_scores(articles, num_topics, output_dir,
     np.save('%s/pmi.npy' % output_dir, pmi)
     return pmi
 
+def get_book_scores(articles, book_offsets, output_dir):
+    """
+    get_scores for every book in one grouped pass. Results are saved together
+    in book_scores.npz, with arrays stacked in the order of titles.
+    """
+    titles = list(book_offsets)
+    lengths = [end - start for start, end in book_offsets.values()]
+    print('Counting co-occurrence for', len(titles), 'books...')
+    cooccur = get_book_cooccurrences(articles, lengths)
+    topic_count = np.diagonal(cooccur, axis1=1, axis2=2).copy()
+    diag = np.arange(cooccur.shape[1])
+    cooccur[:, diag, diag] = 0
+    print('Getting pmi for', len(titles), 'books...')
+    pmi = get_book_pmis(cooccur, topic_count, lengths)
+    np.savez_compressed('%s/book_scores.npz' % output_dir, titles=np.array(titles),
+                        cooccur=cooccur, topic_count=topic_count, pmi=pmi)
+    return pmi
 
-def main():
+def get_preprocess_key(input_file, people_terms, params):
+    """
+    Hash of everything the preprocessing outputs depend on: the input csv,
+    the people terms csv and the cleaning parameters. 
+    """
+    key = {'input_file': file_digest(input_file),
+           'people_terms': file_digest(people_terms),
+           'version': PREPROCESS_VERSION}
+    key.update(params)
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def load_preprocessed(cache_dir, output_dir):
+    """
+    Copies cached preprocessing outputs into output_dir and returns their
+    metadata, or None if nothing complete is cached under cache_dir. 
+    """
+    meta_file = '%s/meta.json' % cache_dir
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, 'r') as infile:
+        meta = json.load(infile)
+    for f in PREPROCESS_FILES:
+        link_or_copy('%s/%s' % (cache_dir, f), '%s/%s' % (output_dir, f))
+    return meta
+
+def save_preprocessed(cache_dir, output_dir, meta):
+    os.makedirs(cache_dir, exist_ok=True)
+    for f in PREPROCESS_FILES:
+        link_or_copy('%s/%s' % (output_dir, f), '%s/%s' % (cache_dir, f))
+    # meta.json is written last, so it marks a complete entry
+    with open('%s/meta.json.tmp' % cache_dir, 'w') as outfile:
+        json.dump(meta, outfile)
+    os.replace('%s/meta.json.tmp' % cache_dir, '%s/meta.json' % cache_dir)
+
+# normalizer of this process, set once by init_worker()
+worker = {}
+
+def init_worker(normalizer):
+    worker['normalizer'] = normalizer
+
+def clean_shard(shard):
+    """
+    Cleans a shard of (key, sentence) rows into (key, tokens). Also returns 
+    the stems first seen in this shard, so workers can pass them back. 
+    """
+    normalizer = worker['normalizer']
+    stemmer = normalizer.stemmer
+    num_stems = len(stemmer) if isinstance(stemmer, StemCache) else 0
+    cleaned = [(key, normalizer.clean(sent)) for key, sent in shard]
+    new_stems = dict(itertools.islice(stemmer.table.items(), num_stems, None)) \
+        if isinstance(stemmer, StemCache) else {}
+    return cleaned, new_stems
+
+
+def iter_shards(items, size=10000):
+    items = iter(items)
+    while True:
+        shard = list(itertools.islice(items, size))
+        if not shard:
+            return
+        yield shard
+
+
+def map_shards(func, shards, num_workers=1, initargs=()):
+    """
+    Runs func on each shard, on a process pool if num_workers > 1. 
+    Each process is set up once with init_worker(*initargs), so only 
+    the shards are sent per task. Yields the results in order. 
+    """
+    if num_workers <= 1:
+        init_worker(*initargs)
+        for shard in shards:
+            yield func(shard)
+        return
+    with multiprocessing.Pool(num_workers, initializer=init_worker, initargs=initargs) as pool:
+        for result in pool.imap(func, shards):
+            yield result
+
+
+def preprocess(output_dir, params):
+    """
+    Cleans the input sentences into a TokenCorpus and writes the MALLET
+    inputs to output_dir. Returns metadata with the number of docs per book, 
+    in order. 
+    """
+    # outputs may be hard links into the cache, so never write through them
+    for f in PREPROCESS_FILES:
+        if os.path.exists('%s/%s' % (output_dir, f)):
+            os.remove('%s/%s' % (output_dir, f))
     print("Loading and cleaning data...")
-    book_texts = defaultdict(list)
-    book2length = Counter()
-    all_text = []
+    # stems from a previous run in this output_dir are reused
+    stem_cache_file = '%s/stem_cache.json' % output_dir
+    stem_cache = StemCache.load(stem_cache_file)
+    normalizer = TextNormalizer(stem=params['stem'],
+                                remove_short=True,
+                                remove_stopwords=True, 
+                                round_dates=params['round_dates'],
+                                stemmer=stem_cache)
+    builder = TokenCorpusBuilder()
+    # doc-topics row of every input row, -1 if dropped
+    states, sentence_ids, doc_rows = [], array('q'), array('q')
     with open(args.input_file, 'r') as infile: 
         reader = csv.DictReader(infile)
-        for row in reader: 
-            book_title = row['book_filename']
-            sent = row['sentence'] 
-            tokens = clean_text(sent,
-                                 stem=args.stem,
-                                 remove_short=True,
-                                 remove_stopwords=True, 
-                                 round_dates=True)
-            if len(tokens) < 5: continue
-            t = ' '.join(tokens)
-            book_texts[book_title].append(t)
-            all_text.append(t)
-            book2length[book_title] += 1
+        missing = [c for c in INPUT_COLUMNS if c not in (reader.fieldnames or [])]
+        if missing: 
+            raise ValueError("%s is missing the columns %s, see --input_file" % (args.input_file, ', '.join(missing)))
+        rows = (((row['state'], row['sentence_id'], row['book_filename']), row['sentence'])
+                for row in reader)
+        for cleaned, new_stems in map_shards(clean_shard, iter_shards(rows), num_workers=args.num_workers,
+                                              initargs=(normalizer,)):
+            if args.num_workers > 1:
+                stem_cache.update(new_stems)
+            for (state, sentence_id, book_title), tokens in cleaned:
+                states.append(state)
+                sentence_ids.append(int(sentence_id))
+                if len(tokens) < params['min_tokens']: 
+                    doc_rows.append(-1)
+                    continue
+                doc_rows.append(len(builder))
+                builder.add(tokens, book_title)
+    save_doc_index(output_dir, states, sentence_ids, doc_rows)
+    if params['stem']: 
+        stem_cache.save(stem_cache_file)
+    corpus = builder.finish()
+    corpus.save('%s/corpus' % output_dir)
 
-    output_dir = os.path.abspath(args.output_dir)
+    # generate mallet topics
+    vocab_dict, word_ids, doc_starts = get_mallet_input(corpus, output_dir,
+                                                        vocab_size=params['vocab_size'])
+    np.savez('%s/doc_terms.npz' % output_dir, word_ids=word_ids, doc_starts=doc_starts)
+    return {'book2length': list(corpus.book_lengths().items()),
+            'num_docs': len(corpus),
+            'vocab_size': len(vocab_dict)}
+
+def prepare_output_dir(output_dir, params):
+    """
+    Fills output_dir with the preprocessed MALLET inputs, from the cache
+    if possible, and returns their metadata. 
+    """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-
-    print(args.num_topics, "topics")
-    num_topics = args.num_topics
-    cooccur_func = functools.partial(generate_cooccurrence_from_int_set,
-                                     num_topics=num_topics)
-
-
-    # generate mallet topics
-    get_mallet_input_from_words(all_text, output_dir)
-
-    # run mallet to prepare topics inputs
+    # preprocessing does not depend on the number of topics, so runs with
+    # the same inputs and cleaning parameters share it through the cache
+    key = get_preprocess_key(args.input_file, args.people_terms, params)
+    cache_root = args.cache_dir or os.path.join(os.path.dirname(output_dir), '.topic_cache')
+    cache_dir = os.path.join(cache_root, key)
+    meta = load_preprocessed(cache_dir, output_dir)
+    if meta is None:
+        meta = preprocess(output_dir, params)
+        save_preprocessed(cache_dir, output_dir, meta)
+    else:
+        print("Using preprocessed data from", cache_dir)
+    return meta
+
+def run_topic_model(output_dir, num_topics, meta):
+    """
+    Trains one topic model on the inputs in output_dir and scores it. 
+    Returns a summary row for the sweep table. 
+    """
+    start = time.perf_counter()
+    book2length = Counter(dict(meta['book2length']))
+    num_docs = meta['num_docs']
+    doc_terms = np.load('%s/doc_terms.npz' % output_dir)
+
+    print(num_topics, "topics")
+    cooccur_func = generate_cooccurrence
+
+    # run mallet (or the in-process sampler) to prepare topics inputs
     # users can also generate mallet-style topic inputs inputs
-    logging.info("running mallet to get topics")
-    if not os.path.exists(os.path.join(args.mallet_dir, 'mallet')):
-        sys.exit("Error: Unable to find mallet at %s" % args.mallet_dir)
-    os.system("./mallet.sh %s %s %d" % (args.mallet_dir,
-                                        output_dir,
-                                        num_topics))
+    logging.info("running %s to get topics" % args.backend)
+    if args.backend == 'gibbs':
+        backend = GibbsBackend(num_iterations=args.iterations)
+    else:
+        backend = MalletBackend(args.mallet_dir)
+    backend.train(output_dir, num_topics, doc_terms['word_ids'], doc_terms['doc_starts'],
+                  meta['vocab_size'])
+    # binary copy of doc-topics.gz for memory-mapped loading
+    save_doc_topic_matrix('%s/doc-topics.gz' % output_dir)
+    train_time = time.perf_counter() - start
 
 
     # load mallet outputs (threshold for keeping a topic = 0.1)
-    articles, vocab, topic_names = load_articles(all_text, output_dir, threshold=.1)
+    articles, vocab, topic_names = load_articles(range(num_docs), output_dir, threshold=.1)
     save_topic_names = '%s/topic_names.json' % output_dir
     with open(save_topic_names, 'w') as f:
         f.write(json.dumps(topic_names))
@@ -312,20 +598,58 @@ def main():
 
     print("Separating topics per book...")
 
-    doc_topic_file = '%s/doc-topics.gz' % output_dir
-    doc_topics = open(doc_topic_file).read().splitlines()
+    doc_topics = load_doc_topic_matrix('%s/doc-topics.gz' % output_dir)
     print(len(doc_topics), 'articles total')
-    prev = 0
-    for title in book2length:
-        length = book2length[title]
-        book_output_dir = "%s/%s" % (output_dir, title)
-        if not os.path.exists(book_output_dir):
-            os.makedirs(book_output_dir)
-        with open(book_output_dir + '/doc-topics.gz', 'w') as outf:
-            outf.write('\n'.join(doc_topics[prev:prev + length]))
-
-        get_scores(articles[prev:prev + length], num_topics, book_output_dir, cooccur_func)
-        prev += length
+    book_offsets = save_book_offsets(output_dir, book2length)
+    get_book_scores(articles, book_offsets, output_dir)
+
+    topic_words = load_topic_word_ids('%s/topic-words.gz' % output_dir)
+    coherence = umass_coherence(doc_terms['word_ids'], doc_terms['doc_starts'],
+                                meta['vocab_size'], topic_words)
+    log_likelihood = round(backend.history[-1][2], 4) if args.backend == 'gibbs' else ''
+    return {'num_topics': num_topics,
+            'output_dir': output_dir,
+            'train_seconds': round(train_time, 1),
+            'total_seconds': round(time.perf_counter() - start, 1),
+            'umass_coherence': round(float(np.mean(coherence)), 4),
+            'log_likelihood_per_token': log_likelihood}
+
+def write_sweep_table(output_dir, results):
+    sweep_file = '%s/sweep.csv' % output_dir
+    with open(sweep_file, 'w') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        for row in results:
+            writer.writerow(row)
+    print("Wrote", sweep_file)
+    for row in results:
+        print("%(num_topics)d topics\tcoherence %(umass_coherence)s\tLL/token %(log_likelihood_per_token)s\t"
+              "%(train_seconds)s sec training, %(total_seconds)s sec total" % row)
+
+
+def main():
+    output_dir = os.path.abspath(args.output_dir)
+    topic_counts = [int(k) for k in args.num_topics.split(',')]
+    if len(topic_counts) == 1:
+        run_dirs = [output_dir]
+    else:
+        # one model per K under output_dir
+        run_dirs = ['%s/topics_%d' % (output_dir, k) for k in topic_counts]
+
+    params = {'stem': args.stem,
+              'round_dates': True,
+              'min_tokens': 5,
+              'vocab_size': 10000}
+    # the first run preprocesses, the rest reuse the cache
+    metas = [prepare_output_dir(run_dir, params) for run_dir in run_dirs]
+
+    if len(run_dirs) == 1 or args.sweep_workers <= 1:
+        results = [run_topic_model(d, k, m) for d, k, m in zip(run_dirs, topic_counts, metas)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.sweep_workers) as executor:
+            results = list(executor.map(run_topic_model, run_dirs, topic_counts, metas))
+    if len(run_dirs) > 1:
+        write_sweep_table(output_dir, results)
 
 
 if __name__ == "__main__":
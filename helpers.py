@@ -3,170 +3,489 @@
 # Authors: Dora Demszky (ddemszky@stanford.edu) and Lucy Li (lucy3_li@berkeley.edu)
 import codecs
 import glob
+import hashlib
+import math
+import os
 import string
 import nltk
 import re
 from collections import defaultdict, Counter
+from array import array
 import csv
+import json
+import numpy as np
+from lexicon import Lexicon
 
 stopwords = open("wordlists/stopwords/en/mallet.txt", "r").read().splitlines()
 punct_chars = list((set(string.punctuation) | {'»', '–', '—', '-',"­", '\xad', '-', '◾', '®', '©','✓','▲', '◄','▼','►', '~', '|', '“', '”', '…', "'", "`", '_', '•', '*', '■'} - {"'"}))
 punct_chars.sort()
 punctuation = ''.join(punct_chars)
+punct_set = set(punct_chars)
 replace = re.compile('[%s]' % re.escape(punctuation))
+url_regex = re.compile(r'http\S*|\S*\.com\S*|\S*www\S*')
 sno = nltk.stem.SnowballStemmer('english')
 printable = set(string.printable)
 
+def file_digest(path, block_size=1 << 20): 
+    '''
+    sha1 of a file's contents, read in blocks. 
+    '''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as infile: 
+        for block in iter(lambda: infile.read(block_size), b''): 
+            sha.update(block)
+    return sha.hexdigest()
+
+class StemCache(object):
+    '''
+    Memoized SnowballStemmer.stem. The vocabulary is far smaller than
+    the number of tokens, so most calls become a dict lookup. Once the
+    table holds @max_size words, new words are stemmed but not stored. 
+    
+    The table is a plain dict, so it can be pickled to worker processes
+    and merged back with update(), or saved next to the topic outputs
+    and loaded again to warm-start a rerun. 
+    '''
+    def __init__(self, table=None, max_size=1000000, stemmer=sno):
+        self.table = dict(table) if table else {}
+        self.max_size = max_size
+        self.stemmer = stemmer
+
+    def __len__(self): 
+        return len(self.table)
+
+    def stem(self, word): 
+        try: 
+            return self.table[word]
+        except KeyError: 
+            stemmed = self.stemmer.stem(word)
+            if len(self.table) < self.max_size: 
+                self.table[word] = stemmed
+            return stemmed
+
+    def stem_words(self, words): 
+        table = self.table
+        return [table[w] if w in table else self.stem(w) for w in words]
+
+    def update(self, table): 
+        '''
+        Adds stems computed elsewhere, e.g. by another worker. 
+        '''
+        for word, stemmed in table.items(): 
+            if len(self.table) >= self.max_size: 
+                break
+            self.table.setdefault(word, stemmed)
+
+    def save(self, path): 
+        with open(path + '.tmp', 'w', encoding='utf-8') as outfile: 
+            json.dump(self.table, outfile)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, max_size=1000000): 
+        '''
+        Loads a saved table, or starts an empty one if @path does not exist. 
+        '''
+        cache = cls(max_size=max_size)
+        if os.path.exists(path): 
+            with open(path, 'r', encoding='utf-8') as infile: 
+                cache.update(json.load(infile))
+        return cache
+
+class _NormalizeTable(dict):
+    '''
+    Combined str.translate table: punctuation and unicode whitespace
+    become a space, other non-printable characters are dropped. 
+    Entries are filled in lazily the first time a character is seen. 
+    '''
+    def __missing__(self, code):
+        c = chr(code)
+        if c in punct_set or c.isspace(): 
+            value = ' '
+        elif c in printable: 
+            value = c
+        else: 
+            value = None
+        self[code] = value
+        return value
+
+class TextNormalizer(object):
+    '''
+    Compiled version of clean_text. The stopword set, translation table 
+    and url regex are built once, so cleaning many sentences only pays 
+    for one regex pass, one translate and one loop over the words. 
+    
+    normalizer = TextNormalizer(round_dates=True)
+    for tokens in normalizer.clean_texts(sentences): 
+        ...
+    '''
+    def __init__(self,
+                 remove_stopwords=True,
+                 remove_numeric=True,
+                 stem=False,
+                 remove_short=True, 
+                 round_dates=False,
+                 stemmer=None):
+        self.remove_stopwords = remove_stopwords
+        self.remove_numeric = remove_numeric
+        self.stem = stem
+        self.remove_short = remove_short
+        self.round_dates = round_dates
+        if stemmer is None: 
+            stemmer = StemCache()
+        # anything with a stem(word) method, e.g. a shared StemCache
+        self.stemmer = stemmer
+        self.stopwords = frozenset(stopwords)
+        self.table = _NormalizeTable()
+        self.urls = url_regex
+
+    def clean(self, text): 
+        # lower case and eliminate urls
+        text = self.urls.sub(' ', text.lower())
+        # punctuation and whitespace to spaces, drop non-printable chars
+        words = text.translate(self.table).split()
+        if not (self.remove_stopwords or self.remove_numeric or self.round_dates 
+                or self.stem or self.remove_short): 
+            return words
+        stops = self.stopwords if self.remove_stopwords else ()
+        new_words = []
+        for w in words: 
+            if w in stops: 
+                continue
+            if w.isdigit(): 
+                if self.remove_numeric: 
+                    continue
+                if self.round_dates and len(w) == 4 and (w[0] == '1' or w[0] == '2'): 
+                    w = str(int(round(int(w), -1)))
+            if self.stem: 
+                w = self.stemmer.stem(w)
+            if self.remove_short and len(w) < 3: 
+                continue
+            new_words.append(w)
+        return new_words
+
+    def clean_texts(self, texts): 
+        '''
+        Yields the cleaned tokens of each text in @texts, in order. 
+        '''
+        clean = self.clean
+        for text in texts: 
+            yield clean(text)
+
+_normalizers = {}
+
+def get_normalizer(**kwargs): 
+    '''
+    Returns a shared TextNormalizer for these cleaning options. 
+    '''
+    key = tuple(sorted(kwargs.items()))
+    if key not in _normalizers: 
+        _normalizers[key] = TextNormalizer(**kwargs)
+    return _normalizers[key]
+
 def clean_text(text,
                remove_stopwords=True,
                remove_numeric=True,
                stem=False,
                remove_short=True, 
                round_dates=False):
-    # lower case
-    text = text.lower()
-    # eliminate urls
-    text = re.sub(r'http\S*|\S*\.com\S*|\S*www\S*', ' ', text)
-    # substitute all other punctuation with whitespace
-    text = replace.sub(' ', text)
-    # replace all whitespace with a single space
-    text = re.sub(r'\s+', ' ', text)
-    # strip off spaces on either end
-    text = text.strip()
-    # make sure all chars are printable
-    text = ''.join([c for c in text if c in printable])
-    words = text.split()
-    if remove_stopwords:
-        words = [w for w in words if w not in stopwords]
-    if remove_numeric:
-        words = [w for w in words if not w.isdigit()]
-    if round_dates: 
-        new_words = []
-        for w in words: 
-            if len(w) == 4 and (w.startswith('1') or w.startswith('2')) and w.isdigit(): 
-                rounded = str(int(round(int(w), -1)))
-                new_words.append(rounded)
-            else: 
-                new_words.append(w)
-        words = new_words
-    if stem:
-        words = [sno.stem(w) for w in words]
-    if remove_short:
-        words = [w for w in words if len(w) >= 3]
-    return words
+    return get_normalizer(remove_stopwords=remove_stopwords,
+                          remove_numeric=remove_numeric,
+                          stem=stem,
+                          remove_short=remove_short,
+                          round_dates=round_dates).clean(text)
 
 def split_terms_into_sets(people_terms_path): 
     '''
     This is customized to split terms into AAPI words
     or non-AAPI words (these are allocated to "not_marks"). 
     '''
-    possible_marks = set() 
-    not_marks = set() # everything else
-    with open(people_terms_path, 'r') as infile: 
-        for line in infile: 
-            contents = line.strip().split(',')
-            term = contents[0].lower()
-            if contents[2] == 'aapi': 
-                possible_marks.add(term)
-            else: 
-                not_marks.add(term)
-    return possible_marks, not_marks
+    lexicon = Lexicon.load(people_terms_path)
+    return lexicon.possible_marks, lexicon.not_marks
 
 def get_word_to_category(people_terms_path): 
     '''
     word2dem = {'bridesmaid':['women'], 'latina': ['women', 'latinx']}
     This was customized for AAPI vs. all other terms. 
     '''
-    word2dem = defaultdict(set)
-    with open(people_terms_path, 'r') as infile: 
-        for line in infile: 
-            contents = line.strip().split(',')
-            term = contents[0]
-            category = contents[1]
-            if category == 'aapi': 
-                word2dem[term].add(category)
-                if '-' in term: 
-                    new_term = term.replace('-', ' ')
-                    word2dem[new_term].add(category)
-            else: 
-                word2dem[term].add('other')
-    return word2dem
-
-def get_aapi_term_dict(aapi_terms, nlp): 
-    aapi_terms_dict = defaultdict(list) # { term token length : terms } 
-    for term in aapi_terms: 
-        term_doc = nlp(term, disable=['parser', 'tagger', 'entity'])
-        new_term = []
-        for tok in term_doc: 
-            new_term.append(tok.text)
-        aapi_terms_dict[len(new_term)].append(term)
-        if '-' in term: 
-            term = term.replace('-', ' ')
-            term_doc = nlp(term, disable=['parser', 'tagger', 'entity'])
-            new_term = []
-            for tok in term_doc: 
-                new_term.append(tok.text)
-            aapi_terms_dict[len(new_term)].append(term)
-    return aapi_terms_dict
+    return Lexicon.load(people_terms_path).word2dem
 
 def get_people_terms(people_terms_path): 
     '''
     Custom for this project. 
     Returns two sets of terms: one for AAPI, one for everyone else
     '''
-    aapi_terms = set()
-    other_terms = set()
-    with open(people_terms_path, 'r') as infile: 
-        reader = csv.reader(infile)
-        for row in reader: 
-            term = row[0].lower()
-            category = row[1]
-            if category == 'aapi': 
-                aapi_terms.add(term)
-                aapi_terms.add(term.replace('-', ' '))
-            else: 
-                other_terms.add(term)
-    return aapi_terms, other_terms
+    lexicon = Lexicon.load(people_terms_path)
+    return lexicon.aapi_terms, lexicon.other_terms
 
 def get_people_terms_by_cat(people_terms_path): 
     '''
     Returns a set of all people terms and a mapping
     from term to race/ethnicity category
     '''
-    race_eth_cats = {} # term to race/ethnicity category
-    all_terms = set() # all terms that refer to people
-    with open(people_terms_path, 'r') as infile: 
-        reader = csv.reader(infile)
-        for row in reader: 
-            term = row[0].lower()
-            category = row[1]
-            cat_type = row[2]
-            if cat_type == 'race/ethnicity': 
-                race_eth_cats[term] = category
-                race_eth_cats[term.replace('-', ' ')] = category
-            all_terms.add(term)
-    # a term cannot have a term within it that is already considered
-    # a person to avoid double counting their presence 
-    all_terms_clean = set()
-    for term in all_terms: 
-        if '-' in term: 
-            tokens = set(term.replace('-', ' ').split())
-            if tokens & all_terms: 
-                continue
-        all_terms_clean.add(term)
-    return race_eth_cats, all_terms_clean
+    lexicon = Lexicon.load(people_terms_path)
+    return lexicon.race_eth_cats, lexicon.all_terms
+
+class Corpus(object):
+    '''
+    A directory of book .txt files, read lazily. Listing books does not
+    open them, and lines() streams one book line by line, so only the
+    line being processed is held in memory. Line boundaries are the same
+    as str.splitlines() on the whole book. 
+    
+    Each book also gets a line offset index, saved under @index_dir
+    (by default a hidden folder in the corpus directory) and rebuilt if
+    the book changes, so that line(title, n) is a single seek and read. 
+    
+    books = Corpus('data/coref_resolved_ca')
+    for title, textbook_lines in books.items(): 
+        ...
+    '''
+    def __init__(self, path, index_dir=None, verbose=False):
+        print('Getting books from', path)
+        self.path = path
+        if index_dir is None: 
+            index_dir = os.path.join(path, '.line_index')
+        self.index_dir = index_dir
+        self.files = {} # title : path to txt file
+        for f in sorted(glob.glob(path + '/*.txt')): 
+            title = f.split('/')[-1].replace('.txt', '')
+            self.files[title] = f
+            if verbose: 
+                print(title)
+        self._offsets = {}
+
+    def __iter__(self): 
+        return iter(self.files)
+
+    def __len__(self): 
+        return len(self.files)
+
+    def __contains__(self, title): 
+        return title in self.files
+
+    def titles(self): 
+        return list(self.files)
+
+    def items(self): 
+        '''
+        Yields (title, line generator) for each book in title order. 
+        '''
+        for title in self.files: 
+            yield title, self.lines(title)
+
+    def text(self, title): 
+        with codecs.open(self.files[title], 'r', encoding='utf-8') as infile: 
+            return infile.read()
+
+    def lines(self, title): 
+        # utf-8 never has a \n byte inside a character, so splitting raw
+        # lines on \n and then splitlines() gives the whole-text split
+        with open(self.files[title], 'rb') as infile: 
+            for raw in infile: 
+                for line in raw.decode('utf-8').splitlines(): 
+                    yield line
+
+    def num_lines(self, title): 
+        return len(self.offsets(title)) - 1
+
+    def line(self, title, n): 
+        '''
+        Returns line @n (0-indexed) of book @title. 
+        '''
+        offsets = self.offsets(title)
+        if n < 0: 
+            n += len(offsets) - 1
+        if n < 0 or n >= len(offsets) - 1: 
+            raise IndexError('line %d out of range for %s' % (n, title))
+        with open(self.files[title], 'rb') as infile: 
+            infile.seek(offsets[n])
+            raw = infile.read(offsets[n + 1] - offsets[n])
+        line = raw.decode('utf-8').splitlines()
+        return line[0] if line else ''
+
+    def offsets(self, title): 
+        '''
+        Byte offset where each line starts, followed by the file size. 
+        '''
+        if title not in self._offsets: 
+            self._offsets[title] = self._load_offsets(title)
+        return self._offsets[title]
+
+    def _load_offsets(self, title): 
+        stat = os.stat(self.files[title])
+        index_file = os.path.join(self.index_dir, title + '.idx')
+        # the first two values record which version of the book was indexed
+        key = (stat.st_size, stat.st_mtime_ns)
+        if os.path.exists(index_file): 
+            index = array('q')
+            with open(index_file, 'rb') as infile: 
+                index.frombytes(infile.read())
+            if tuple(index[:2]) == key: 
+                return index[2:]
+        offsets = array('q')
+        pos = 0
+        with open(self.files[title], 'rb') as infile: 
+            for raw in infile: 
+                pieces = raw.decode('utf-8').splitlines(True)
+                if len(pieces) == 1: 
+                    offsets.append(pos)
+                else: 
+                    start = pos
+                    for piece in pieces: 
+                        offsets.append(start)
+                        start += len(piece.encode('utf-8'))
+                pos += len(raw)
+        offsets.append(pos)
+        try: 
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(index_file + '.tmp', 'wb') as outfile: 
+                array('q', key).tofile(outfile)
+                offsets.tofile(outfile)
+            os.replace(index_file + '.tmp', index_file)
+        except OSError: 
+            # read-only corpus, keep the index in memory only
+            pass
+        return offsets
 
 def get_book_txts(path, splitlines=False, verbose=False):
-    print('Getting books from', path)
-    bookfiles = sorted([f for f in glob.glob(path + '/*.txt')])
+    '''
+    Reads every book in @path into memory. Prefer Corpus, which streams. 
+    '''
+    corpus = Corpus(path, verbose=verbose)
     books = {}
-    for f in bookfiles:
-        txt = codecs.open(f, 'r', encoding='utf-8').read()
+    for title in corpus:
         if splitlines:
-            txt = txt.splitlines()
-        title = f.split('/')[-1].replace('.txt', '')
-        books[title] = txt
-        if verbose: 
-            print(title)
+            books[title] = list(corpus.lines(title))
+        else: 
+            books[title] = corpus.text(title)
     print("Finished getting books.")
-    return books
\ No newline at end of file
+    return books
+
+# whitespace after the end of a sentence
+sentence_end_regex = re.compile(r'(?<=[.!?])\s+')
+
+def within_budget(num_chars, num_tokens, max_chars=None, max_tokens=None): 
+    return (max_chars is None or num_chars <= max_chars) and \
+        (max_tokens is None or num_tokens <= max_tokens)
+
+def split_line(line, max_chars=None, max_tokens=None): 
+    '''
+    Splits a line that is over the budget into pieces between sentences, 
+    each as many whole sentences as fit. A sentence that is over the 
+    budget on its own is a piece by itself. 
+    '''
+    sents = [] # (start, end, number of tokens)
+    start = 0
+    for m in sentence_end_regex.finditer(line): 
+        sents.append((start, m.start(), len(line[start:m.start()].split())))
+        start = m.end()
+    sents.append((start, len(line), len(line[start:].split())))
+    pieces = []
+    start, end, num_tokens = sents[0]
+    for s, e, t in sents[1:]: 
+        if within_budget(e - start, num_tokens + t, max_chars, max_tokens): 
+            end = e
+            num_tokens += t
+        else: 
+            pieces.append(line[start:end])
+            start, end, num_tokens = s, e, t
+    pieces.append(line[start:end])
+    return pieces
+
+def chunk_lines(lines, max_chars=None, max_tokens=None, split_lines=True): 
+    '''
+    Packs consecutive lines into chunks, lists of lines, of at most 
+    @max_chars characters and @max_tokens tokens (counting a '\n' between 
+    lines). Tokens are counted as whitespace-separated words, which is 
+    a bit fewer than spaCy's tokens. Chunks end between lines, so short 
+    lines are parsed together and long ones do not make huge batches. 
+    
+    A line over the budget is a chunk of its own, or with @split_lines is
+    cut between sentences into several one-line chunks, see split_line(). 
+    
+    for docs in pipe_chunks(nlp, chunk_lines(books.lines(title), max_chars=20000)): 
+        ...
+    
+    run_coref.py instead parses each chunk as one '\n'-joined text, so 
+    coreference can cross lines. 
+    '''
+    chunk = []
+    num_chars = 0
+    num_tokens = 0
+    for line in lines: 
+        line_chars = len(line)
+        line_tokens = len(line.split())
+        if not within_budget(line_chars, line_tokens, max_chars, max_tokens): 
+            if chunk: 
+                yield chunk
+                chunk, num_chars, num_tokens = [], 0, 0
+            if split_lines: 
+                for piece in split_line(line, max_chars, max_tokens): 
+                    yield [piece]
+            else: 
+                yield [line]
+            continue
+        # lines are joined with '\n'
+        sep = 1 if chunk else 0
+        if chunk and not within_budget(num_chars + sep + line_chars, num_tokens + line_tokens, 
+                                       max_chars, max_tokens): 
+            yield chunk
+            chunk, num_chars, num_tokens, sep = [], 0, 0, 0
+        chunk.append(line)
+        num_chars += sep + line_chars
+        num_tokens += line_tokens
+    if chunk: 
+        yield chunk
+
+def pipe_chunks(nlp, chunks): 
+    '''
+    Parses every line of @chunks (e.g. from chunk_lines()) as its own Doc, 
+    with the lines of a chunk as one nlp.pipe batch. So the budget bounds 
+    a batch, but a sentence never spans two lines and the Docs are the same 
+    as parsing one line at a time. Yields the list of Docs of each chunk. 
+    '''
+    for chunk in chunks: 
+        yield list(nlp.pipe(chunk, batch_size=len(chunk)))
+
+class HyperLogLog(object):
+    '''
+    Approximate number of distinct strings, in 2^@p one-byte registers
+    (16 KB for p=14) however many strings are added. The standard error
+    is about 1.04 / sqrt(2^p), 0.8% for p=14. Strings are hashed with
+    blake2b, so sketches made in different processes or runs agree and
+    can be merged. Like a set, it has update() and len(). 
+    '''
+    def __init__(self, p=14, registers=None): 
+        # the hash bits left after the register index have to fit in a float64
+        assert 11 <= p <= 18
+        self.p = p
+        if registers is None: 
+            registers = np.zeros(1 << p, dtype=np.uint8)
+        self.registers = np.asarray(registers, dtype=np.uint8)
+
+    def update(self, items): 
+        p = self.p
+        hashes = np.fromiter((int.from_bytes(hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest(), 'little')
+                              for item in set(items)), dtype=np.uint64)
+        if not len(hashes): 
+            return
+        index = (hashes >> np.uint64(64 - p)).astype(np.int64)
+        rest = (hashes & np.uint64((1 << (64 - p)) - 1)).astype(np.float64)
+        # frexp gives the bit length, so rank is the position of the first 1 bit
+        bit_length = np.frexp(rest)[1]
+        rank = (64 - p + 1 - bit_length).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other): 
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def __len__(self): 
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros: 
+            # linear counting is better for small counts
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
@@ -0,0 +1,428 @@
+'''
+People terms lexicon and matching of (possibly multi-word) terms
+against token sequences.
+
+lexicon = Lexicon.load('wordlists/people_terms.csv')
+matcher = TermMatcher.from_people_terms('wordlists/people_terms.csv')
+prefilter = TermPrefilter.from_people_terms('wordlists/people_terms.csv')
+if prefilter.might_match(line): doc = nlp(line)
+toks = [tok.text.lower() for tok in chunk]
+terms = matcher.terms_in(toks)
+'''
+from collections import defaultdict
+import csv
+import hashlib
+import os
+import pickle
+import random
+import re
+
+term_tok_regex = re.compile(r"[^\s-]+|-")
+
+def tokenize_term(term):
+    '''
+    Splits a term the way spaCy's tokenizer does for our wordlist,
+    e.g. "sri-lankan" -> ["sri", "-", "lankan"]
+    '''
+    return term_tok_regex.findall(term.lower())
+
+class ContextRule(object):
+    '''
+    A term starting with @prefix only counts if @cue is also among the tokens.
+    If @adjacent, the cue has to come right before the term.
+    '''
+    def __init__(self, prefix, cue, adjacent=False):
+        self.prefix = prefix
+        self.cue = cue
+        self.adjacent = adjacent
+
+    def applies_to(self, term):
+        return term.startswith(self.prefix)
+
+    def allows(self, tokens, start, token_set):
+        if self.adjacent:
+            return start > 0 and tokens[start - 1] == self.cue
+        return self.cue in token_set
+
+def indian_rule(adjacent=False):
+    '''
+    Edge case where "Indian" in textbooks does not usually refer to
+    Indians from Asia, so we only count it next to "Asian".
+    '''
+    return ContextRule('indian', 'asian', adjacent=adjacent)
+
+class Lexicon(object):
+    '''
+    Every view of the people terms csv (term, category, category type),
+    built in one pass over the file: 
+    - aapi_terms, other_terms: as in helpers.get_people_terms
+    - race_eth_cats, all_terms: as in helpers.get_people_terms_by_cat
+    - word2dem: as in helpers.get_word_to_category
+    - possible_marks, not_marks: as in helpers.split_terms_into_sets
+    - terms_by_category: {category : terms}, with dashes also as spaces
+    - term_tokens: {term : tuple of tokens} for every AAPI term
+    
+    Lexicon.load() saves the built object as a pickle named after a hash
+    of the csv, so later runs just unpickle it until the csv changes. 
+    '''
+    # bump when the views change so old pickles are not reused
+    VERSION = 1
+
+    def __init__(self, people_terms_path):
+        self.path = people_terms_path
+        self.aapi_terms = set()
+        self.other_terms = set()
+        self.race_eth_cats = {} # term to race/ethnicity category
+        self.word2dem = defaultdict(set)
+        self.possible_marks = set()
+        self.not_marks = set()
+        self.terms_by_category = defaultdict(set)
+        all_terms = set() # all terms that refer to people
+        with open(people_terms_path, 'r') as infile:
+            reader = csv.reader(infile)
+            for row in reader:
+                raw_term = row[0]
+                term = raw_term.lower()
+                category = row[1]
+                cat_type = row[2]
+                no_dash = term.replace('-', ' ')
+                self.terms_by_category[category].add(term)
+                self.terms_by_category[category].add(no_dash)
+                if category == 'aapi':
+                    self.aapi_terms.add(term)
+                    self.aapi_terms.add(no_dash)
+                    self.word2dem[raw_term].add(category)
+                    if '-' in raw_term:
+                        self.word2dem[raw_term.replace('-', ' ')].add(category)
+                else:
+                    self.other_terms.add(term)
+                    self.word2dem[raw_term].add('other')
+                if cat_type == 'race/ethnicity':
+                    self.race_eth_cats[term] = category
+                    self.race_eth_cats[no_dash] = category
+                if cat_type == 'aapi':
+                    self.possible_marks.add(term)
+                else:
+                    self.not_marks.add(term)
+                all_terms.add(term)
+        # a term cannot have a term within it that is already considered
+        # a person to avoid double counting their presence
+        self.all_terms = set()
+        for term in all_terms:
+            if '-' in term:
+                tokens = set(term.replace('-', ' ').split())
+                if tokens & all_terms:
+                    continue
+            self.all_terms.add(term)
+        self.people = self.aapi_terms | self.other_terms
+        self.term_tokens = {term: tuple(tokenize_term(term)) for term in self.aapi_terms}
+
+    @staticmethod
+    def cache_path(people_terms_path, digest):
+        folder, name = os.path.split(os.path.abspath(people_terms_path))
+        return os.path.join(folder, '.cache', '%s.%s.pkl' % (name, digest))
+
+    @classmethod
+    def load(cls, people_terms_path):
+        '''
+        Returns the Lexicon for this csv, from memory or the pickle if the
+        csv has not changed, otherwise builds and saves it.
+        '''
+        with open(people_terms_path, 'rb') as infile:
+            digest = hashlib.sha1(infile.read()).hexdigest()[:16]
+        key = (os.path.abspath(people_terms_path), digest)
+        if key in _lexicons:
+            return _lexicons[key]
+        cache_file = cls.cache_path(people_terms_path, digest)
+        lexicon = None
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as infile:
+                    version, lexicon = pickle.load(infile)
+                if version != cls.VERSION:
+                    lexicon = None
+            except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+                lexicon = None
+        if lexicon is None:
+            lexicon = cls(people_terms_path)
+            try:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                with open(cache_file + '.tmp', 'wb') as outfile:
+                    pickle.dump((cls.VERSION, lexicon), outfile, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(cache_file + '.tmp', cache_file)
+            except OSError:
+                # read-only wordlist folder, rebuild next time
+                pass
+        _lexicons[key] = lexicon
+        return lexicon
+
+_lexicons = {}
+
+term_piece_regex = re.compile(r"[^\W_]+")
+
+class TermPrefilter(object):
+    '''
+    Cheap check on raw text, before parsing, of whether it can contain a
+    term from each of @term_sets. Text and terms are split into runs of
+    letters and digits, and a term can only be among spaCy's tokens if
+    all of its runs are in the text. So text that contains a term is never
+    rejected, but some accepted text will not contain one.
+
+    Skipped text can be sampled at @audit_rate to parse anyway and check
+    that it gives the same (empty) output, see record_audit(). Or larger
+    units, e.g. whole books, can be sampled with sample_audit(), and
+    @audit_unit names them in the summary.
+    '''
+    def __init__(self, term_sets, audit_rate=0.0, seed=0, audit_unit='skips'):
+        self.first_pieces = []
+        for terms in term_sets:
+            first_pieces = defaultdict(list)
+            for term in terms:
+                pieces = term_piece_regex.findall(term.lower())
+                if not pieces:
+                    # no way to check for it, so keep everything
+                    first_pieces = None
+                    break
+                first_pieces[pieces[0]].append(pieces[1:])
+            self.first_pieces.append(first_pieces)
+        self.audit_rate = audit_rate
+        self.audit_unit = audit_unit
+        self.rng = random.Random(seed)
+        self.num_checked = 0
+        self.num_skipped = 0
+        self.num_audited = 0
+        self.num_audit_failures = 0
+
+    @classmethod
+    def from_people_terms(cls, people_terms_path, views=('people',), **kwargs):
+        '''
+        Prefilter for the terms in the given Lexicon views,
+        e.g. ('people', 'aapi_terms') for text with both.
+        '''
+        lexicon = Lexicon.load(people_terms_path)
+        return cls([getattr(lexicon, view) for view in views], **kwargs)
+
+    def _contains(self, first_pieces, pieces):
+        if first_pieces is None:
+            return True
+        for piece in pieces:
+            for rest in first_pieces.get(piece, ()):
+                if all(p in pieces for p in rest):
+                    return True
+        return False
+
+    def might_match(self, text):
+        pieces = set(term_piece_regex.findall(text.lower()))
+        return all(self._contains(f, pieces) for f in self.first_pieces)
+
+    def check(self, text, audit=True):
+        '''
+        Returns (parse, audit): whether @text has to be parsed, and
+        whether it could be skipped but was sampled for an audit.
+        With audit=False skipped text is never sampled.
+        '''
+        self.num_checked += 1
+        if self.might_match(text):
+            return True, False
+        self.num_skipped += 1
+        if audit and self.sample_audit():
+            return True, True
+        return False, False
+
+    def sample_audit(self):
+        '''
+        Whether to audit the next unit, at @audit_rate.
+        '''
+        if self.audit_rate > 0 and self.rng.random() < self.audit_rate:
+            self.num_audited += 1
+            return True
+        return False
+
+    def record_audit(self, same_output):
+        if not same_output:
+            self.num_audit_failures += 1
+
+    def counts(self):
+        return (self.num_checked, self.num_skipped, self.num_audited, self.num_audit_failures)
+
+    def add_counts(self, counts):
+        '''
+        Adds the counts() of another prefilter, e.g. one in a worker process.
+        '''
+        self.num_checked += counts[0]
+        self.num_skipped += counts[1]
+        self.num_audited += counts[2]
+        self.num_audit_failures += counts[3]
+
+    def summary(self):
+        rate = self.num_skipped / max(self.num_checked, 1)
+        text = "prefilter skipped %d of %d (%.1f%%)" % (self.num_skipped, self.num_checked, 100 * rate)
+        if self.num_audited:
+            text += ", audit: %d of %d sampled %s differ" % (self.num_audit_failures, self.num_audited, self.audit_unit)
+        return text
+
+class TermMatcher(object):
+    '''
+    Token trie over a set of terms. find() checks every start position of
+    a token sequence against the trie, so matching is linear in the number
+    of tokens (terms are at most a few tokens long) instead of looping
+    over every term. Matches respect token boundaries: "indian" does not
+    match inside "indiana".
+    '''
+    def __init__(self, terms, rules=()):
+        self.trie = {}
+        self.rules = list(rules)
+        self.terms = set()
+        for term in terms:
+            self.add(term)
+
+    @classmethod
+    def from_people_terms(cls, people_terms_path, category='aapi', rules=None):
+        '''
+        Matcher for all terms of @category in the people terms csv,
+        by default with the "indian" rule.
+        '''
+        if rules is None:
+            rules = [indian_rule()]
+        lexicon = Lexicon.load(people_terms_path)
+        return cls(lexicon.terms_by_category[category], rules=rules)
+
+    def add(self, term):
+        term = term.strip()
+        self.terms.add(term)
+        # "sri-lankan" is one token if text was split on whitespace only
+        for form in {tuple(tokenize_term(term)), tuple(term.split())}:
+            node = self.trie
+            for tok in form:
+                node = node.setdefault(tok, {})
+            # None is never a token, so it can mark the end of a term
+            node[None] = term
+
+    def find(self, tokens, use_rules=True):
+        '''
+        Returns (start, end, term) for every match in @tokens,
+        which should already be lowercased.
+        '''
+        matches = []
+        trie = self.trie
+        for start in range(len(tokens)):
+            node = trie.get(tokens[start])
+            end = start + 1
+            while node is not None:
+                term = node.get(None)
+                if term is not None:
+                    matches.append((start, end, term))
+                if end == len(tokens):
+                    break
+                node = node.get(tokens[end])
+                end += 1
+        if use_rules and self.rules and matches:
+            token_set = set(tokens)
+            matches = [m for m in matches if self._allowed(tokens, m, token_set)]
+        return matches
+
+    def _allowed(self, tokens, match, token_set):
+        for rule in self.rules:
+            if rule.applies_to(match[2]) and not rule.allows(tokens, match[0], token_set):
+                return False
+        return True
+
+    def terms_in(self, tokens, use_rules=True):
+        '''
+        Returns the set of terms found in @tokens.
+        '''
+        return set(m[2] for m in self.find(tokens, use_rules=use_rules))
+
+    def matches(self, tokens, use_rules=True):
+        return bool(self.find(tokens, use_rules=use_rules))
+
+class SentenceMatcher(object):
+    '''
+    Everything people_location.py looks for in a sentence, in one pass
+    over its lowercased tokens:
+    - AAPI terms anywhere in the sentence, with @sent_matcher
+    - AAPI terms in each noun chunk, with @chunk_matcher
+    - for noun chunks headed by a person, their 1-3 grams that are
+      AAPI terms (locations), race/ethnicity terms or people terms
+
+    Noun chunks are spans of the sentence's tokens, so nothing is
+    lowercased twice. Only n-grams starting with the first word of a
+    term are joined and looked up, and one dict holds what every term is.
+    '''
+    MAX_N = 3
+
+    def __init__(self, sent_matcher, chunk_matcher, aapi_terms, race_eth_cats, all_terms, use_rules=True):
+        self.sent_matcher = sent_matcher
+        self.chunk_matcher = chunk_matcher
+        self.use_rules = use_rules
+        self.all_terms = all_terms
+        self.ngram_info = {} # n-gram : (is aapi, race/ethnicity category or None, is a person)
+        for term in aapi_terms | set(race_eth_cats) | all_terms:
+            self.ngram_info[term] = (term in aapi_terms, race_eth_cats.get(term), term in all_terms)
+        # an n-gram is tokens joined by spaces, so it can only be a
+        # term if its first token is a term's first word
+        self.first_words = set(term.split(' ')[0] for term in self.ngram_info)
+
+    @classmethod
+    def from_people_terms(cls, people_terms_path, use_rules=True):
+        '''
+        The matcher people_location.py uses: in sentences, "indian" needs
+        to follow "asian", in noun chunks "asian" can be anywhere.
+        '''
+        lexicon = Lexicon.load(people_terms_path)
+        sent_matcher = TermMatcher.from_people_terms(people_terms_path, rules=[indian_rule(adjacent=True)])
+        chunk_matcher = TermMatcher.from_people_terms(people_terms_path, rules=[indian_rule()])
+        return cls(sent_matcher, chunk_matcher, lexicon.aapi_terms, lexicon.race_eth_cats, lexicon.all_terms,
+                   use_rules=use_rules)
+
+    def match(self, toks, chunks, sentence_ID, results):
+        '''
+        Adds the hits of one sentence to @results, a dict with 'term' and
+        'location' ({term : [sentence IDs]}), 'noun' ({term : [chunk texts]})
+        and 'race_eth' (a Counter). @toks are the sentence's lowercased
+        tokens and @chunks has (start, end, root, text) for each noun
+        chunk, with token positions in the sentence.
+        Returns whether the sentence has an AAPI location.
+        '''
+        use_rules = self.use_rules
+        for term in self.sent_matcher.terms_in(toks, use_rules=use_rules):
+            results['term'][term].append(sentence_ID)
+        noun_result = results['noun']
+        location_result = results['location']
+        race_eth_counts = results['race_eth']
+        ngram_info = self.ngram_info
+        first_words = self.first_words
+        is_aapi = False
+        for start, end, root, text in chunks:
+            chunk_toks = toks[start:end]
+            for term in self.chunk_matcher.terms_in(chunk_toks, use_rules=use_rules):
+                noun_result[term].append(text.strip())
+            # check that head of noun is a person
+            if toks[root] not in self.all_terms:
+                continue
+            has_asian = None
+            for n in range(1, self.MAX_N + 1):
+                for i in range(start, end - n + 1):
+                    first = toks[i]
+                    # in textbooks, Indian often refers to Native Americans, not Asians
+                    if use_rules and first.startswith('indian'):
+                        if has_asian is None:
+                            has_asian = 'asian' in chunk_toks
+                        if not has_asian:
+                            race_eth_counts['all'] += 1
+                            continue
+                    # a token with a space in it could still start a term
+                    if first not in first_words and ' ' not in first:
+                        continue
+                    ngram = first if n == 1 else ' '.join(toks[i:i + n])
+                    info = ngram_info.get(ngram)
+                    if info is None:
+                        continue
+                    if info[0]:
+                        is_aapi = True
+                        location_result[ngram].append(sentence_ID)
+                    if info[1] is not None:
+                        race_eth_counts[info[1]] += 1
+                    if info[2]:
+                        race_eth_counts['all'] += 1
+        return is_aapi
@@ -0,0 +1,200 @@
+'''
+One SQLite file with everything people_location.py finds, for every
+book of every state, instead of five json files per book:
+- postings: sorted sentence IDs of each (state, book, term), for term
+  hits anywhere in a sentence ('term') and in person noun chunks
+  ('location'), stored as zlib compressed int32 deltas
+- counts: race/ethnicity ('race_eth') and name ('name') counts
+- nouns: the noun chunks each AAPI term was found in
+
+Adding a book replaces what the index had for it, so one book can be
+reprocessed without rebuilding the rest.
+
+index = LocationIndex('logs/people_locations.sqlite')
+index.add_book('CA', title, results)
+index.sentences(state='CA') # {(state, title) : sentence IDs with any AAPI term}
+index.term_counts(by='state') # {state : Counter of term hits}
+index.close()
+
+Existing json outputs can be loaded with
+python location_index.py --index logs/people_locations.sqlite --output_prefix logs/ca --state CA
+'''
+from collections import Counter, defaultdict
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import zlib
+import numpy as np
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (book_id INTEGER PRIMARY KEY, state TEXT, title TEXT, UNIQUE (state, title));
+CREATE TABLE IF NOT EXISTS postings (book_id INTEGER, kind TEXT, term TEXT, num INTEGER, sentences BLOB,
+                                     PRIMARY KEY (book_id, kind, term));
+CREATE TABLE IF NOT EXISTS counts (book_id INTEGER, kind TEXT, key TEXT, num INTEGER,
+                                   PRIMARY KEY (book_id, kind, key));
+CREATE TABLE IF NOT EXISTS nouns (book_id INTEGER, term TEXT, chunks TEXT, PRIMARY KEY (book_id, term));
+CREATE INDEX IF NOT EXISTS postings_term ON postings (kind, term);
+'''
+
+# people_location.py output folder of each kind of result
+JSON_DIRS = {'location': '_people_locations',
+             'term': '_term_locations',
+             'noun': '_nouns',
+             'race_eth': '_race_eth',
+             'name': '_names'}
+
+POSTING_KINDS = ('term', 'location')
+COUNT_KINDS = ('race_eth', 'name')
+
+def encode_postings(sentence_ids):
+    # IDs are added in sentence order, so deltas are small
+    ids = np.asarray(sentence_ids, dtype=np.int64)
+    deltas = np.diff(ids, prepend=0).astype(np.int32)
+    return zlib.compress(deltas.tobytes())
+
+def decode_postings(blob):
+    deltas = np.frombuffer(zlib.decompress(blob), dtype=np.int32)
+    return np.cumsum(deltas, dtype=np.int64)
+
+class LocationIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def add_book(self, state, title, results):
+        '''
+        Replaces the book's entries with @results, as built by
+        people_location.py: {'location', 'term', 'noun', 'race_eth', 'name'}.
+        '''
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO books (state, title) VALUES (?, ?)', (state, title))
+            book_id = self.conn.execute('SELECT book_id FROM books WHERE state = ? AND title = ?',
+                                        (state, title)).fetchone()[0]
+            for table in ('postings', 'counts', 'nouns'):
+                self.conn.execute('DELETE FROM %s WHERE book_id = ?' % table, (book_id,))
+            self.conn.executemany('INSERT INTO postings VALUES (?, ?, ?, ?, ?)',
+                                  [(book_id, kind, term, len(ids), encode_postings(ids))
+                                   for kind in POSTING_KINDS for term, ids in results[kind].items()])
+            self.conn.executemany('INSERT INTO counts VALUES (?, ?, ?, ?)',
+                                  [(book_id, kind, key, num)
+                                   for kind in COUNT_KINDS for key, num in results[kind].items()])
+            self.conn.executemany('INSERT INTO nouns VALUES (?, ?, ?)',
+                                  [(book_id, term, json.dumps(chunks)) for term, chunks in results['noun'].items()])
+
+    def add_json_dirs(self, output_prefix, state):
+        '''
+        Adds every book people_location.py wrote under @output_prefix.
+        '''
+        titles = sorted(os.path.basename(f)[:-len('.json')]
+                        for f in glob.glob(output_prefix + JSON_DIRS['term'] + '/*.json'))
+        for title in titles:
+            results = {}
+            for kind, suffix in JSON_DIRS.items():
+                with open(output_prefix + suffix + '/' + title + '.json', 'r') as infile:
+                    results[kind] = json.load(infile)
+            self.add_book(state, title, results)
+        return titles
+
+    def _where(self, state=None, title=None):
+        clauses, params = [], []
+        if state is not None:
+            clauses.append('books.state = ?')
+            params.append(state)
+        if title is not None:
+            clauses.append('books.title = ?')
+            params.append(title)
+        return ''.join(' AND ' + c for c in clauses), params
+
+    def books(self, state=None):
+        '''
+        [(state, title)] of the books in the index.
+        '''
+        where, params = self._where(state)
+        return self.conn.execute('SELECT state, title FROM books WHERE 1' + where +
+                                 ' ORDER BY state, title', params).fetchall()
+
+    def postings(self, kind='term', terms=None, state=None, title=None):
+        '''
+        {(state, title) : {term : sentence IDs}}, for every term or only @terms.
+        A sentence ID is repeated for every hit in the sentence.
+        '''
+        where, params = self._where(state, title)
+        query = 'SELECT state, title, term, sentences FROM postings JOIN books USING (book_id) ' \
+                'WHERE kind = ?' + where
+        params = [kind] + params
+        if terms is not None:
+            terms = list(terms)
+            query += ' AND term IN (%s)' % ','.join('?' * len(terms))
+            params += terms
+        res = defaultdict(dict)
+        for state, title, term, blob in self.conn.execute(query, params):
+            res[(state, title)][term] = decode_postings(blob)
+        return res
+
+    def sentences(self, kind='term', terms=None, match='any', state=None, title=None):
+        '''
+        {(state, title) : sorted unique sentence IDs} with any (or, with
+        match='all', every one) of @terms, by default any term at all.
+        '''
+        res = {}
+        for book, book_postings in self.postings(kind, terms, state, title).items():
+            if match == 'all':
+                if terms is None or len(book_postings) < len(set(terms)):
+                    continue
+                ids = None
+                for term_ids in book_postings.values():
+                    ids = np.unique(term_ids) if ids is None else np.intersect1d(ids, term_ids)
+            else:
+                ids = np.unique(np.concatenate(list(book_postings.values())))
+            res[book] = ids
+        return res
+
+    def term_counts(self, kind='term', by='state', state=None):
+        '''
+        Number of hits of each term, as {state : Counter} or, with
+        by='book', {(state, title) : Counter}.
+        '''
+        where, params = self._where(state)
+        group = 'books.state' if by == 'state' else 'books.state, books.title'
+        query = 'SELECT %s, term, SUM(num) FROM postings JOIN books USING (book_id) WHERE kind = ?%s ' \
+                'GROUP BY %s, term' % (group, where, group)
+        res = defaultdict(Counter)
+        for row in self.conn.execute(query, [kind] + params):
+            key = row[0] if by == 'state' else (row[0], row[1])
+            res[key][row[-2]] += row[-1]
+        return res
+
+    def counts(self, kind='name', state=None, title=None):
+        '''
+        Counter of race/ethnicity categories ('race_eth') or names ('name'),
+        summed over the matching books.
+        '''
+        where, params = self._where(state, title)
+        query = 'SELECT key, SUM(num) FROM counts JOIN books USING (book_id) WHERE kind = ?' + where + \
+                ' GROUP BY key'
+        return Counter(dict(self.conn.execute(query, [kind] + params).fetchall()))
+
+    def nouns(self, state, title):
+        where, params = self._where(state, title)
+        query = 'SELECT term, chunks FROM nouns JOIN books USING (book_id) WHERE 1' + where
+        return {term: json.loads(chunks) for term, chunks in self.conn.execute(query, params)}
+
+    def close(self):
+        self.conn.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', required=True)
+    parser.add_argument('--output_prefix', required=True, help="The --output_prefix people_location.py was run with.")
+    parser.add_argument('--state', required=True)
+    args = parser.parse_args()
+    index = LocationIndex(args.index)
+    titles = index.add_json_dirs(args.output_prefix, args.state)
+    index.close()
+    print("Added", len(titles), "books to", args.index)
+
+if __name__ == '__main__':
+    main()
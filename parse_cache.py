@@ -0,0 +1,200 @@
+'''
+On-disk cache of full en_core_web_trf parses, shared by the scripts
+that use the trf model: get_descriptors.py, people_location.py and
+get_topic_probabilities.py.
+
+Each text is cached exactly as a script parses it (a chunk of lines, a
+line or a sentence), so a script gets the same Doc from the cache as it
+would from nlp, and scripts share a parse whenever they parse the same
+text, e.g. a line that is one sentence. The full pipeline is cached, and
+scripts that exclude components for speed load them anyway when they use
+the cache, which does not change the components they do use.
+
+Docs are stored in DocBin shards under a folder named after the model
+(name and version), keyed by a hash of their text. Each shard has a
+.keys file next to it with the keys of its docs in order, written after
+the shard, so a shard without keys is ignored. Shards are only ever
+added, with unique names, so several processes can share a cache folder.
+
+parser = load_parser(args.parse_cache, exclude=["ner", "lemmatizer"])
+doc = parser(line)
+for doc in parser.pipe(sentences, batch_size=64): ...
+parser.close()
+
+Without a cache_dir, ParseCache just calls nlp, here en_core_web_trf
+without the @exclude components.
+'''
+from collections import OrderedDict
+import glob
+import hashlib
+import os
+import uuid
+import numpy as np
+
+MODEL = 'en_core_web_trf'
+KEY_SIZE = 16
+
+def text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()[:KEY_SIZE]
+
+def pipeline_name(nlp):
+    '''
+    Folder name for a model, e.g. en_core_web_trf-3.4.1
+    '''
+    meta = nlp.meta
+    return '%s_%s-%s' % (meta.get('lang', ''), meta.get('name', ''), meta.get('version', ''))
+
+def load_parser(cache_dir=None, exclude=()):
+    '''
+    en_core_web_trf wrapped in a ParseCache. The cache only holds full
+    parses, so with a @cache_dir the @exclude components are loaded anyway.
+    '''
+    import spacy
+    if cache_dir:
+        return ParseCache(spacy.load(MODEL), cache_dir)
+    return ParseCache(spacy.load(MODEL, exclude=list(exclude)))
+
+def load_sentencizer():
+    '''
+    en_core_web_trf with only a rule-based sentencizer, as in
+    generate_sentence_csv.py, to count the sentences of text that is
+    not parsed.
+    '''
+    import spacy
+    nlp = spacy.load(MODEL, exclude=["transformer", "ner", "tagger", "parser", "attribute_ruler", "lemmatizer"])
+    nlp.add_pipe('sentencizer')
+    return nlp
+
+def count_sentences(sentencizer, text):
+    return sum(1 for _ in sentencizer(text).sents)
+
+class ParseCache(object):
+    '''
+    Drop-in for calling nlp: __call__ and pipe() return Docs from the
+    cache or parse them. New Docs are written out in shards of about
+    @shard_tokens tokens, and close() writes the rest.
+    '''
+    def __init__(self, nlp, cache_dir=None, shard_tokens=200000, max_loaded_shards=4):
+        self.nlp = nlp
+        # docs are written out once this many tokens are pending
+        self.shard_tokens = shard_tokens
+        self.max_loaded_shards = max_loaded_shards
+        self.folder = None
+        self.index = {} # key : (shard path, position)
+        self.loaded = OrderedDict() # shard path : docs, least recently used first
+        self.pending_keys = []
+        self.pending_docs = []
+        self.pending_tokens = 0
+        self.num_hits = 0
+        self.num_parsed = 0
+        if cache_dir:
+            self.folder = os.path.join(cache_dir, pipeline_name(nlp))
+            os.makedirs(self.folder, exist_ok=True)
+            for keys_file in sorted(glob.glob(os.path.join(self.folder, '*.keys'))):
+                self._add_shard(keys_file[:-len('.keys')] + '.spacy', keys_file)
+
+    def _add_shard(self, shard, keys_file):
+        with open(keys_file, 'rb') as infile:
+            data = infile.read()
+        for pos in range(len(data) // KEY_SIZE):
+            key = data[pos * KEY_SIZE:(pos + 1) * KEY_SIZE]
+            self.index.setdefault(key, (shard, pos))
+
+    def _load(self, shard, docs):
+        self.loaded[shard] = docs
+        if len(self.loaded) > self.max_loaded_shards:
+            self.loaded.popitem(last=False)
+
+    def _shard_docs(self, shard):
+        from spacy.tokens import DocBin
+        if shard in self.loaded:
+            self.loaded.move_to_end(shard)
+            return self.loaded[shard]
+        docs = list(DocBin().from_disk(shard).get_docs(self.nlp.vocab))
+        self._load(shard, docs)
+        return docs
+
+    def _get(self, key):
+        if key in self.index:
+            shard, pos = self.index[key]
+            if shard is None:
+                return self.pending_docs[pos]
+            return self._shard_docs(shard)[pos]
+        return None
+
+    def __call__(self, text):
+        return next(self.pipe([text]))
+
+    def pipe(self, texts, batch_size=64):
+        '''
+        Yields a Doc for every text in order, parsing only texts that are
+        not cached. Repeated texts are parsed once.
+        '''
+        if self.folder is None:
+            for doc in self.nlp.pipe(texts, batch_size=batch_size):
+                self.num_parsed += 1
+                yield doc
+            return
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) >= batch_size:
+                for doc in self._parse_batch(batch, batch_size):
+                    yield doc
+                batch = []
+        if batch:
+            for doc in self._parse_batch(batch, batch_size):
+                yield doc
+
+    def _parse_batch(self, texts, batch_size):
+        keys = [text_key(text) for text in texts]
+        missing = OrderedDict()
+        for key, text in zip(keys, texts):
+            if key not in self.index and key not in missing:
+                missing[key] = text
+        self.num_hits += len(texts) - len(missing)
+        for key, doc in zip(missing, self.nlp.pipe(missing.values(), batch_size=batch_size)):
+            self._store(key, doc)
+        self.num_parsed += len(missing)
+        return [self._get(key) for key in keys]
+
+    def _store(self, key, doc):
+        # transformer outputs are not needed once a doc is parsed, and
+        # would hold (GPU) memory for every pending doc
+        if doc.has_extension('trf_data'):
+            doc._.trf_data = None
+        doc.tensor = np.empty((0,), dtype=np.float32)
+        # not yet on disk, so the index points into pending_docs
+        self.index[key] = (None, len(self.pending_docs))
+        self.pending_keys.append(key)
+        self.pending_docs.append(doc)
+        self.pending_tokens += len(doc)
+        if self.pending_tokens >= self.shard_tokens:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes parsed docs that are not on disk yet as a new shard.
+        '''
+        if self.folder is None or not self.pending_docs:
+            return
+        from spacy.tokens import DocBin
+        name = os.path.join(self.folder, uuid.uuid4().hex)
+        doc_bin = DocBin(docs=self.pending_docs)
+        doc_bin.to_disk(name + '.spacy')
+        with open(name + '.keys.tmp', 'wb') as outfile:
+            outfile.write(b''.join(self.pending_keys))
+        os.replace(name + '.keys.tmp', name + '.keys')
+        for pos, key in enumerate(self.pending_keys):
+            self.index[key] = (name + '.spacy', pos)
+        # only docs restored from the shard are kept, not the parsed ones
+        self._load(name + '.spacy', list(doc_bin.get_docs(self.nlp.vocab)))
+        self.pending_keys = []
+        self.pending_docs = []
+        self.pending_tokens = 0
+
+    def close(self):
+        self.flush()
+
+    def summary(self):
+        return "parse cache: %d hits, %d parsed" % (self.num_hits, self.num_parsed)
@@ -4,43 +4,111 @@ Author: Lucy Li
 @input: coref resolved texts
 @output: 
 - location_result: a json of {term : [sentence IDs]} for each book
+- with --index, all results are also added to a location_index.LocationIndex
 '''
-import spacy
 from helpers import *
+from lexicon import SentenceMatcher, TermPrefilter
+from parse_cache import load_parser, load_sentencizer, count_sentences
+from checkpoint import Checkpoint, flush_output
+from location_index import LocationIndex
 from collections import defaultdict
 import json
+import itertools
 import argparse
 import os
 from tqdm import tqdm
-from nltk import ngrams
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_dir', required=True)
 parser.add_argument('--output_prefix', required=True)
 parser.add_argument('--people_terms', required=True)
+parser.add_argument('--parse_cache', help="Folder of en_core_web_trf parses shared across scripts (see parse_cache.py).")
+parser.add_argument('--prefilter', action='store_true', help="Skip parsing lines without a people term, and only "
+                                                             "count their sentences with a sentencizer.")
+parser.add_argument('--audit_rate', default=0.0, type=float, help="Fraction of books to also run without --prefilter, "
+                                                                  "to check that the output is the same.")
+parser.add_argument('--chunk_chars', type=int, help="Batch lines for nlp.pipe in chunks of up to this many characters "
+                                                     "(see helpers.chunk_lines), instead of --batch_size lines. "
+                                                     "Each line is still parsed as its own Doc.")
+parser.add_argument('--chunk_tokens', type=int, help="Like --chunk_chars, but a budget of whitespace-separated tokens.")
+parser.add_argument('--batch_size', default=64, type=int, help="Lines per nlp.pipe batch, without --chunk_chars or --chunk_tokens.")
+parser.add_argument('--index', help="SQLite location index to add every book to (see location_index.py).")
+parser.add_argument('--state', help="State of the books in the index, by default the last part of output_prefix, "
+                                    "e.g. CA for logs/ca.")
+parser.add_argument('--resume', action='store_true', help="Skip books finished before a crashed run stopped.")
 
 args = parser.parse_args()
 
-def get_n_gramlist(nngramlist, toks, n=2):   
-    # stack overflow said this was fastest
-    for s in ngrams(toks,n=n):        
-        nngramlist.append(' '.join(s))                
-    return nngramlist
+def new_results(): 
+    return {'location': defaultdict(list), # {term : [sentence IDs]}
+            'term': defaultdict(list), # {term : [sentence IDs]}
+            'noun': defaultdict(list), # {term : [noun chunks]}
+            'race_eth': Counter(), 
+            'name': Counter()}
+
+def match_sentences(doc, sentence_ID, results, matcher): 
+    '''
+    Adds the term, noun chunk, race/ethnicity and name hits of every 
+    sentence in @doc to @results, numbering sentences on from @sentence_ID. 
+    Returns the last sentence ID. 
+    '''
+    name_counts = results['name']
+    for sent in doc.sents:
+        sentence_ID += 1
+        # lowercased once, noun chunks are spans of the sentence's tokens
+        toks = [tok.text.lower() for tok in sent]
+        offset = sent.start
+        chunks = [(chunk.start - offset, chunk.end - offset, chunk.root.i - offset, chunk.text) 
+                  for chunk in sent.noun_chunks]
+        is_aapi = matcher.match(toks, chunks, sentence_ID, results)
+        
+        # get named people in sentence
+        if is_aapi: 
+            for ent in sent.ents: 
+                if ent.label_ != 'PERSON': continue
+                name_counts[ent.text] += 1
+    return sentence_ID
+
+def match_book(textbook_lines, num_lines, nlp, matcher, prefilter=None, sentencizer=None): 
+    '''
+    Results for the lines of one book. Lines that @prefilter rejects are 
+    not parsed, but @sentencizer counts their sentences, so that the 
+    sentence IDs of later lines do not shift. 
+    '''
+    results = new_results()
+    sentence_ID = 0
+    # (line, whether to parse it)
+    lines = ((line, prefilter is None or prefilter.check(line, audit=False)[0]) 
+             for line in tqdm(textbook_lines, total=num_lines))
+    lines, to_parse = itertools.tee(lines)
+    to_parse = (line for line, parse in to_parse if parse)
+    if args.chunk_chars is None and args.chunk_tokens is None: 
+        docs = nlp.pipe(to_parse, batch_size=args.batch_size)
+    else: 
+        # lines are batched up to the budget, but each is still its own Doc 
+        # and long lines are not split, so sentence IDs are the same
+        chunks = chunk_lines(to_parse, max_chars=args.chunk_chars, max_tokens=args.chunk_tokens, 
+                             split_lines=False)
+        docs = (doc for chunk_docs in pipe_chunks(nlp, chunks) for doc in chunk_docs)
+    for line, parse in lines: 
+        if parse: 
+            sentence_ID = match_sentences(next(docs), sentence_ID, results, matcher)
+        else: 
+            sentence_ID += count_sentences(sentencizer, line)
+    return results
 
 def main(): 
     aapi_terms, other_terms = get_people_terms(args.people_terms)
-    race_eth_cats, all_terms = get_people_terms_by_cat(args.people_terms)
+    _, all_terms = get_people_terms_by_cat(args.people_terms)
     
     # Load your usual SpaCy model (one of SpaCy English models)
-    nlp = spacy.load('en_core_web_trf')
+    nlp = load_parser(args.parse_cache)
     
-    # tokenize aapi terms
-    # terms range from 1 to 3 tokens
-    aapi_terms_dict = get_aapi_term_dict(aapi_terms, nlp)
+    matcher = SentenceMatcher.from_people_terms(args.people_terms, use_rules='online' not in args.output_prefix)
 
     # load books
-    books = get_book_txts(args.input_dir, splitlines=True)
+    books = Corpus(args.input_dir)
 
     location_dir = args.output_prefix + '_people_locations'
     term_dir = args.output_prefix + '_term_locations'
@@ -54,88 +122,57 @@ def main():
     os.makedirs(name_dir, exist_ok=True)
     os.makedirs(term_dir, exist_ok=True)
     
+    prefilter = None
+    sentencizer = None
+    if args.prefilter: 
+        # terms_in on sentences and noun chunks looks for aapi terms, 
+        # everything else needs a chunk headed by one of all_terms
+        prefilter = TermPrefilter([all_terms | aapi_terms], audit_rate=args.audit_rate, audit_unit='books')
+        sentencizer = load_sentencizer()
+    
+    # each book's files are written whole, so the checkpoint only lists finished books
+    checkpoint = Checkpoint(args.output_prefix + '_people_location.checkpoint', resume=args.resume, 
+                            config={'input_dir': os.path.abspath(args.input_dir), 'prefilter': args.prefilter, 
+                                    'chunk_chars': args.chunk_chars, 'chunk_tokens': args.chunk_tokens})
+    done_books = checkpoint.get('books', [])
+    if checkpoint.resumed: 
+        print("Resuming after", len(done_books), "books")
+    
+    index = None
+    if args.index: 
+        index = LocationIndex(args.index)
+        state = args.state or os.path.basename(args.output_prefix).upper()
+    
     for title, textbook_lines in books.items():
+        if title in done_books: 
+            continue
         print(title)
-        location_result = defaultdict(list) # {term : [sentence IDs]}
-        term_result = defaultdict(list) # {term : [sentence IDs]}
-        noun_result = defaultdict(list) # {term : [noun chunks]}
-        race_eth_counts = Counter()
-        name_counts = Counter()
-        sentence_ID = 0
-        for line in tqdm(textbook_lines):
-            doc = nlp(line)
+        results = match_book(textbook_lines, books.num_lines(title), nlp, matcher, prefilter, sentencizer)
+        if prefilter is not None and prefilter.sample_audit(): 
+            # the whole book again without the prefilter
+            audit_results = match_book(books.lines(title), books.num_lines(title), nlp, matcher)
+            prefilter.record_audit(audit_results == results)
+        location_result, term_result, noun_result, race_eth_counts, name_counts = \
+            [results[name] for name in ('location', 'term', 'noun', 'race_eth', 'name')]
             
-            for sent in doc.sents:
-                sentence_ID += 1
-                # count any appearance of AAPI terms
-                toks = [tok.text.lower() for tok in sent]
-                ngramlist = [tok.text.lower() for tok in sent]
-                ngramlist = get_n_gramlist(ngramlist, toks, n=2)
-                ngramlist = get_n_gramlist(ngramlist, toks, n=3)
-                overlap = set(ngramlist) & aapi_terms
-                for term in overlap: 
-                    if 'online' not in args.output_prefix and \
-                    term.startswith('indian') and 'asian ' + term not in set(ngramlist): 
-                        continue
-                    term_result[term].append(sentence_ID)
-                
-                # count only nouns or people appearances
-                is_aapi = False # whether sentence contains AAPI mention
-                for chunk in sent.noun_chunks: 
-                    toks = [tok.text.lower() for tok in chunk]
-                    ngramlist = [tok.text.lower() for tok in chunk]
-                    ngramlist = get_n_gramlist(ngramlist, toks, n=2)
-                    ngramlist = get_n_gramlist(ngramlist, toks, n=3)
-                    overlap = set(ngramlist) & aapi_terms
-                    for term in overlap: 
-                        if 'online' not in args.output_prefix and \
-                        term.startswith('indian') and 'asian' not in set(toks): 
-                            continue
-                        noun_result[term].append(chunk.text.strip())
-                        
-                    noun_phrase = chunk.text.lower()
-                    head_token = chunk.root.text.lower()
-                    # check that head of noun is a person
-                    if head_token not in all_terms:
-                        continue
-                    
-                    # record location of AAPI term
-                    for ngram in ngramlist: 
-                        # special case where in textbooks, 
-                        # Indian often refers to Native Americans, not Asians
-                        if 'online' not in args.output_prefix and \
-                        ngram.startswith('indian') and 'asian' not in set(toks): 
-                            race_eth_counts['all'] += 1
-                            continue
-                            
-                        if ngram in aapi_terms: 
-                            is_aapi = True
-                            location_result[ngram].append(sentence_ID)
-                        if ngram in race_eth_cats: 
-                            race_eth_counts[race_eth_cats[ngram]] += 1
-                        if ngram in all_terms: 
-                            race_eth_counts['all'] += 1
-                
-                # get named people in sentence
-                if is_aapi: 
-                    for ent in sent.ents: 
-                        if ent.label_ != 'PERSON': continue
-                        name_counts[ent.text] += 1
-            
-        with open(noun_dir + '/' + title + '.json', 'w') as outfile: 
-            json.dump(noun_result, outfile)
-        
-        with open(location_dir + '/' + title + '.json', 'w') as outfile: 
-            json.dump(location_result, outfile)
-            
-        with open(term_dir + '/' + title + '.json', 'w') as outfile: 
-            json.dump(term_result, outfile)
-            
-        with open(race_eth_dir + '/' + title + '.json', 'w') as outfile: 
-            json.dump(race_eth_counts, outfile)
-            
-        with open(name_dir + '/' + title + '.json', 'w') as outfile: 
-            json.dump(name_counts, outfile)
+        for folder, result in ((noun_dir, noun_result), (location_dir, location_result), (term_dir, term_result), 
+                               (race_eth_dir, race_eth_counts), (name_dir, name_counts)): 
+            with open(folder + '/' + title + '.json', 'w') as outfile: 
+                json.dump(result, outfile)
+                # on disk before the book is checkpointed
+                flush_output(outfile)
+        if index is not None: 
+            # replaces the book if it was added before
+            index.add_book(state, title, results)
+        done_books.append(title)
+        checkpoint.commit(books=done_books)
+    
+    checkpoint.finish()
+    if index is not None: 
+        index.close()
+    nlp.close()
+    if prefilter is not None: 
+        print(prefilter.summary())
             
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -5,11 +5,17 @@ from helpers import *
 import spacy
 import neuralcoref
 import argparse
+import itertools
 import os
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_dir', required=True)
 parser.add_argument('--output_dir', required=True)
+parser.add_argument('--chunk_chars', type=int, help="Resolve lines packed into chunks of up to this many characters "
+                                                     "(see helpers.chunk_lines), so coref can link mentions across "
+                                                     "lines, instead of one line at a time.")
+parser.add_argument('--chunk_tokens', type=int, help="Like --chunk_chars, but a budget of whitespace-separated tokens.")
+parser.add_argument('--batch_size', default=64, type=int, help="Lines or chunks per nlp.pipe batch.")
 
 args = parser.parse_args()
 
@@ -52,6 +58,29 @@ def get_resolved(doc, clusters):
                     resolved[i] = ""
     return ''.join(resolved)
 
+def resolve_chunks(nlp, textbook_lines):
+    '''
+    Yields the resolved text of every line, in order.
+    '''
+    if args.chunk_chars is None and args.chunk_tokens is None:
+        chunks = ([line] for line in textbook_lines)
+    else:
+        # lines are never split, so output lines match input lines
+        chunks = chunk_lines(textbook_lines, max_chars=args.chunk_chars, max_tokens=args.chunk_tokens,
+                             split_lines=False)
+    chunks, texts = itertools.tee(chunks)
+    for chunk, doc in zip(chunks, nlp.pipe(('\n'.join(chunk) for chunk in texts), batch_size=args.batch_size)):
+        resolved = get_resolved(doc, doc._.coref_clusters)
+        if len(chunk) == 1:
+            yield resolved
+            continue
+        resolved_lines = resolved.split('\n')
+        if len(resolved_lines) != len(chunk):
+            # a mention across lines was replaced, so resolve them one by one
+            resolved_lines = [get_resolved(d, d._.coref_clusters) for d in nlp.pipe(chunk)]
+        for line in resolved_lines:
+            yield line
+
 
 def main():
     # Load your usual SpaCy model (one of SpaCy English models)
@@ -61,16 +90,15 @@ def main():
     neuralcoref.add_to_pipe(nlp, blacklist=True)
 
     # load books
-    books = get_book_txts(args.input_dir, splitlines=True)
+    books = Corpus(args.input_dir)
 
     print('Resolving coref...')
     os.makedirs(args.output_dir, exist_ok=True)
     for title, textbook_lines in books.items():
         print(title)
         with codecs.open(os.path.join(args.output_dir, title + '.txt'), 'w', encoding='utf-8') as f:
-            for line in textbook_lines:
-                doc = nlp(line)
-                f.write(get_resolved(doc, doc._.coref_clusters) + '\n')
+            for line in resolve_chunks(nlp, textbook_lines):
+                f.write(line + '\n')
 
 if __name__ == '__main__':
     main()
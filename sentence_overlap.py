@@ -8,6 +8,7 @@ from nltk import ngrams
 from collections import defaultdict, Counter
 import pandas as pd
 import json
+from sentence_topics import load_sentence_topics
 
 ROOT = '/data0/lucy/asian-american-textbooks/'
 LOGS = ROOT + 'logs/'
@@ -22,11 +23,9 @@ def get_n_gramlist(toks, n=10):
 def find_overlaps(): 
     nlp = spacy.load('en_core_web_trf', exclude=["transformer", "ner", "tagger", "parser", "attribute_ruler", "lemmatizer"])
     
-    dtypes = {'state':str, 'book_id':str, 'book_filename':str, 'subject':str, 
-          'sentence_id':str, 'sentence':str, 'aapi':str}
-    for i in range(50): 
-        dtypes['topic_' + str(i)] = float
-    sent_topics_50 = pd.read_csv(LOGS + 'combined_coref_data_topics_50.csv', dtype=dtypes)
+    # only the columns used here, the topic columns are not needed
+    sent_topics_50 = load_sentence_topics(LOGS + 'combined_coref_data_topics_50.csv', 
+                                          columns=['state', 'sentence_id', 'sentence', 'aapi'])
     aapi_sent_topics_50 = sent_topics_50[sent_topics_50.aapi.notnull()]
     
     CA_df = aapi_sent_topics_50[aapi_sent_topics_50['state'] == 'CA']
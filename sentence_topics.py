@@ -0,0 +1,137 @@
+'''
+The sentence topic table of get_topic_probabilities.py, one row per
+sentence with its topic probabilities. It can be written as csv, Parquet
+or Arrow (see SentenceTopicWriter), and load_sentence_topics reads any of
+them back, optionally only some columns.
+'''
+import csv
+import os
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+def get_table_format(path):
+    '''
+    'parquet' for .parquet, 'arrow' for .arrow or .feather, otherwise 'csv'
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.parquet':
+        return 'parquet'
+    if ext in ('.arrow', '.feather'):
+        return 'arrow'
+    return 'csv'
+
+class SentenceTopicWriter(object):
+    '''
+    Writes the sentence topic table of get_topic_probabilities.py, as csv
+    or, for a .parquet or .arrow @path, as a compressed columnar table
+    with float64 topic columns, which read back the same as the csv's,
+    and dictionary-encoded state, book and subject columns. Empty fields
+    are stored as nulls, which is what pd.read_csv gives for them.
+
+    With @append, rows are added to an existing csv, which is how a run
+    resumes from a checkpoint. Columnar files can only be written whole.
+    '''
+    DICTIONARY_COLUMNS = ('state', 'book_id', 'book_filename', 'subject')
+
+    def __init__(self, path, fieldnames, compression='zstd', append=False):
+        self.path = path
+        self.fieldnames = fieldnames
+        self.format = get_table_format(path)
+        if self.format == 'csv':
+            self.outfile = open(path, 'a' if append else 'w', encoding='utf-8')
+            self.writer = csv.DictWriter(self.outfile, fieldnames=fieldnames)
+            if not append:
+                self.writer.writeheader()
+            return
+        if append:
+            raise ValueError("can only append to a csv, not %s" % path)
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed to write %s" % path)
+        fields = []
+        for name in fieldnames:
+            if name in self.DICTIONARY_COLUMNS:
+                fields.append((name, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+            elif name.startswith('topic_'):
+                fields.append((name, pyarrow.float64()))
+            else:
+                fields.append((name, pyarrow.string()))
+        self.schema = pyarrow.schema(fields)
+        # dictionaries only grow, so arrow batches can be written as deltas
+        self.dictionaries = {name: {} for name in self.DICTIONARY_COLUMNS if name in fieldnames}
+        if self.format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=compression)
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(compression=compression, emit_dictionary_deltas=True)
+            self.writer = pyarrow.ipc.new_file(path, self.schema, options=options)
+
+    def _column(self, name, values, field_type):
+        values = [None if v == '' else v for v in values]
+        if name in self.dictionaries:
+            dictionary = self.dictionaries[name]
+            indices = [None if v is None else dictionary.setdefault(v, len(dictionary)) for v in values]
+            return pyarrow.DictionaryArray.from_arrays(pyarrow.array(indices, type=pyarrow.int32()),
+                                                       pyarrow.array(list(dictionary), type=pyarrow.string()))
+        return pyarrow.array(values, type=field_type)
+
+    def write_rows(self, rows):
+        if self.format == 'csv':
+            for row in rows:
+                self.writer.writerow(row)
+            return
+        columns = [self._column(field.name, [row[field.name] for row in rows], field.type)
+                   for field in self.schema]
+        self.writer.write_batch(pyarrow.record_batch(columns, schema=self.schema))
+
+    def flush(self):
+        '''
+        Makes sure rows written so far are on disk, for a checkpoint.
+        '''
+        if self.format != 'csv':
+            raise ValueError("only csv output can be checkpointed")
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+
+    def close(self):
+        if self.format == 'csv':
+            self.outfile.close()
+        else:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_sentence_topics(path, columns=None, categorical=False):
+    '''
+    The sentence topic table as a DataFrame, with only @columns if given.
+    Columnar files only read those columns from disk. Topic columns are
+    floats and the rest strings, as the notebook reads the csv. With
+    @categorical, dictionary-encoded columns stay pandas categoricals,
+    which use much less memory.
+    '''
+    import pandas as pd
+    table_format = get_table_format(path)
+    if table_format == 'csv':
+        header = pd.read_csv(path, nrows=0).columns
+        dtypes = {name: float if name.startswith('topic_') else str for name in header}
+        return pd.read_csv(path, dtype=dtypes, usecols=columns)
+    if pyarrow is None:
+        raise ImportError("pyarrow is needed to read %s" % path)
+    if table_format == 'parquet':
+        table = pyarrow.parquet.read_table(path, columns=columns)
+    else:
+        table = pyarrow.feather.read_table(path, columns=columns)
+    df = table.to_pandas()
+    if not categorical:
+        for name in df.columns:
+            if isinstance(df[name].dtype, pd.CategoricalDtype):
+                df[name] = df[name].astype(df[name].cat.categories.dtype)
+    return df
@@ -0,0 +1,120 @@
+'''
+Cleaned sentences stored once as integer token ids:
+- tokens: int32 ids of every token, sentence after sentence
+- offsets: int64, sentence i is tokens[offsets[i]:offsets[i + 1]]
+- book_ids: int32 index into books for every sentence
+- vocab: token string of each id, books: book titles
+
+The arrays are saved as .npy files so they can be memory-mapped.
+
+builder = TokenCorpusBuilder()
+for title, tokens in cleaned: builder.add(tokens, title)
+corpus = builder.finish()
+corpus.save('%s/corpus' % output_dir)
+corpus = TokenCorpus.load('%s/corpus' % output_dir)
+'''
+from array import array
+from collections import OrderedDict
+import json
+import numpy as np
+
+class TokenCorpus(object):
+    def __init__(self, tokens, offsets, book_ids, vocab, books):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.book_ids = book_ids
+        self.vocab = vocab
+        self.books = books
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def sentence(self, i):
+        return [self.vocab[t] for t in self.tokens[self.offsets[i]:self.offsets[i + 1]]]
+
+    def book_lengths(self):
+        '''
+        {title : number of sentences}, in the order books first appear
+        '''
+        # book ids are given out in order of appearance
+        counts = np.bincount(self.book_ids, minlength=len(self.books))
+        return OrderedDict((title, int(c)) for title, c in zip(self.books, counts))
+
+    def pair_positions(self):
+        '''
+        Positions i where tokens i and i + 1 are in the same sentence
+        '''
+        n = len(self.tokens)
+        same = np.ones(max(n - 1, 0), dtype=bool)
+        # the last token of each sentence does not pair with the next one
+        ends = np.asarray(self.offsets[1:-1]) - 1
+        same[ends[(ends >= 0) & (ends < n - 1)]] = False
+        return np.flatnonzero(same)
+
+    def sentence_of(self, positions):
+        '''
+        Sentence index of each token position
+        '''
+        return np.searchsorted(self.offsets, positions, side='right') - 1
+
+    @staticmethod
+    def paths(prefix):
+        return {'tokens': prefix + '.tokens.npy',
+                'offsets': prefix + '.offsets.npy',
+                'book_ids': prefix + '.book_ids.npy',
+                'vocab': prefix + '.vocab.json'}
+
+    def save(self, prefix):
+        paths = self.paths(prefix)
+        np.save(paths['tokens'], np.asarray(self.tokens, dtype=np.int32))
+        np.save(paths['offsets'], np.asarray(self.offsets, dtype=np.int64))
+        np.save(paths['book_ids'], np.asarray(self.book_ids, dtype=np.int32))
+        with open(paths['vocab'], 'w') as outfile:
+            json.dump({'vocab': self.vocab, 'books': self.books}, outfile)
+        return list(paths.values())
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        paths = cls.paths(prefix)
+        mmap_mode = 'r' if mmap else None
+        with open(paths['vocab'], 'r') as infile:
+            names = json.load(infile)
+        return cls(np.load(paths['tokens'], mmap_mode=mmap_mode),
+                   np.load(paths['offsets'], mmap_mode=mmap_mode),
+                   np.load(paths['book_ids'], mmap_mode=mmap_mode),
+                   names['vocab'], names['books'])
+
+class TokenCorpusBuilder(object):
+    '''
+    Appends token lists one sentence at a time, without keeping the strings.
+    '''
+    def __init__(self):
+        self.token2id = {}
+        self.vocab = []
+        self.book2id = {}
+        self.books = []
+        self.tokens = array('i')
+        self.offsets = array('q', [0])
+        self.book_ids = array('i')
+
+    def __len__(self):
+        return len(self.book_ids)
+
+    def _id(self, table, names, name):
+        i = table.get(name)
+        if i is None:
+            i = table[name] = len(names)
+            names.append(name)
+        return i
+
+    def add(self, tokens, book):
+        token2id, vocab = self.token2id, self.vocab
+        self.tokens.extend(self._id(token2id, vocab, t) for t in tokens)
+        self.offsets.append(len(self.tokens))
+        self.book_ids.append(self._id(self.book2id, self.books, book))
+
+    def finish(self):
+        return TokenCorpus(np.frombuffer(self.tokens, dtype=np.int32),
+                           np.frombuffer(self.offsets, dtype=np.int64),
+                           np.frombuffer(self.book_ids, dtype=np.int32),
+                           self.vocab, self.books)
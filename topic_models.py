@@ -0,0 +1,458 @@
+'''
+Topic model backends for get_topics.py. Each backend trains on the
+MALLET input prepared in output_dir and writes doc-topics.gz and
+topic-words.gz there in MALLET's format, so load_articles reads
+either one the same way.
+
+- MalletBackend runs ./mallet.sh, which needs a JVM and MALLET.
+- GibbsBackend is an in-process collapsed Gibbs sampler. It is compiled
+  with numba if it is installed, and runs as (much slower) Python otherwise.
+'''
+import json
+import logging
+import math
+import os
+import sys
+import time
+import numpy as np
+from scipy import sparse
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def jit(func):
+    if numba is None:
+        return func
+    return numba.njit(cache=True)(func)
+
+def get_doc_topic_npy(doc_topic_file):
+    return os.path.join(os.path.dirname(doc_topic_file), 'doc-topics.npy')
+
+def parse_doc_topics(doc_topic_file, num_docs=None):
+    '''
+    Parses MALLET doc-topics text into a docs x topics float32 matrix.
+    '''
+    rows = []
+    with open(doc_topic_file) as tfin:
+        for line in tfin:
+            if num_docs is not None and len(rows) >= num_docs:
+                break
+            rows.append(line.split()[2:])
+    return np.array(rows, dtype=np.float32)
+
+def save_doc_topic_matrix(doc_topic_file):
+    '''
+    Writes the doc-topics.npy copy of @doc_topic_file and returns its path.
+    '''
+    npy_file = get_doc_topic_npy(doc_topic_file)
+    np.save(npy_file, parse_doc_topics(doc_topic_file))
+    return npy_file
+
+def load_doc_topic_matrix(doc_topic_file, num_docs=None):
+    '''
+    Docs x topics probabilities, optionally only the first num_docs.
+    Memory-maps doc-topics.npy if it is at least as new as
+    @doc_topic_file, and parses the text otherwise.
+    '''
+    npy_file = get_doc_topic_npy(doc_topic_file)
+    if os.path.exists(npy_file) and (not os.path.exists(doc_topic_file) or
+            os.path.getmtime(npy_file) >= os.path.getmtime(doc_topic_file)):
+        matrix = np.load(npy_file, mmap_mode='r')
+        return matrix if num_docs is None else matrix[:num_docs]
+    return parse_doc_topics(doc_topic_file, num_docs=num_docs)
+
+def save_book_offsets(topic_dir, book2length):
+    '''
+    @book2length: number of doc-topics rows of each book, in row order
+    Saves and returns {title : [start row, end row]}.
+    '''
+    book_offsets = {}
+    prev = 0
+    for title, length in book2length.items():
+        book_offsets[title] = [prev, prev + length]
+        prev += length
+    with open('%s/book_offsets.json' % topic_dir, 'w') as outfile:
+        json.dump(book_offsets, outfile)
+    return book_offsets
+
+def load_book_offsets(topic_dir):
+    with open('%s/book_offsets.json' % topic_dir, 'r') as infile:
+        return json.load(infile)
+
+def save_doc_index(topic_dir, states, sentence_ids, doc_rows):
+    '''
+    Saves doc_index.npz: for every row of the input csv, its state and
+    sentence_id and the doc-topics row it became, or -1 if the sentence
+    was dropped while cleaning. sentence_id restarts in each state, so
+    rows are keyed by both.
+    '''
+    state_names = sorted(set(states))
+    state2id = {s: i for i, s in enumerate(state_names)}
+    np.savez('%s/doc_index.npz' % topic_dir,
+             states=np.array(state_names),
+             state_ids=np.array([state2id[s] for s in states], dtype=np.int32),
+             sentence_ids=np.asarray(sentence_ids, dtype=np.int64),
+             doc_rows=np.asarray(doc_rows, dtype=np.int64))
+
+class DocIndex(object):
+    '''
+    doc_index.npz sorted for lookups: one int64 key per row,
+    state_id * stride + sentence_id, where the stride is one more than the
+    largest sentence_id, and the doc-topics row of each key.
+    '''
+    def __init__(self, states, state_ids, sentence_ids, doc_rows):
+        self.state2id = {str(s): i for i, s in enumerate(states)}
+        self.stride = int(sentence_ids.max(initial=-1)) + 1
+        keys = state_ids.astype(np.int64) * self.stride + sentence_ids
+        order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[order]
+        self.sorted_rows = doc_rows[order]
+
+def load_doc_index(topic_dir):
+    index_file = '%s/doc_index.npz' % topic_dir
+    if not os.path.exists(index_file):
+        raise IOError("%s not found, rerun get_topics.py to write it" % index_file)
+    with np.load(index_file) as index:
+        return DocIndex(index['states'], index['state_ids'], index['sentence_ids'], index['doc_rows'])
+
+def lookup_doc_rows(doc_index, states, sentence_ids):
+    '''
+    Doc-topics row of each (state, sentence_id) pair, or -1 if it was
+    dropped or is not in @doc_index (a DocIndex).
+    '''
+    state_ids = np.array([doc_index.state2id.get(s, -1) for s in states], dtype=np.int64)
+    sentence_ids = np.asarray(sentence_ids, dtype=np.int64)
+    if len(doc_index.sorted_keys) == 0:
+        return np.full(len(state_ids), -1, dtype=np.int64)
+    # sentence_ids past the stride are not in the index
+    valid = (state_ids >= 0) & (sentence_ids >= 0) & (sentence_ids < doc_index.stride)
+    keys = state_ids * doc_index.stride + sentence_ids
+    pos = np.minimum(np.searchsorted(doc_index.sorted_keys, keys), len(doc_index.sorted_keys) - 1)
+    found = valid & (doc_index.sorted_keys[pos] == keys)
+    return np.where(found, doc_index.sorted_rows[pos], -1)
+
+def load_book_scores(topic_dir):
+    '''
+    Per-book scores saved by get_topics.py, as
+    {title : {'cooccur': ..., 'topic_count': ..., 'pmi': ...}}
+    '''
+    with np.load('%s/book_scores.npz' % topic_dir) as bundle:
+        return {str(title): {name: bundle[name][b] for name in ('cooccur', 'topic_count', 'pmi')}
+                for b, title in enumerate(bundle['titles'])}
+
+def load_topic_word_ids(topic_word_file, top=10):
+    '''
+    Returns the @top word ids of each topic in topic-words.gz, in topic order.
+    '''
+    topic_words = {}
+    with open(topic_word_file) as fin:
+        for line in fin:
+            parts = line.strip().split()
+            topic_words[int(parts[0])] = [int(w) for w in parts[2:2 + top]]
+    return [topic_words[k] for k in sorted(topic_words)]
+
+def umass_coherence(word_ids, doc_starts, vocab_size, topic_words):
+    '''
+    UMass coherence of each topic's top words (Mimno et al. 2011), from
+    the document frequencies of words and word pairs in the corpus.
+    Higher (closer to 0) is more coherent.
+    '''
+    num_docs = len(doc_starts) - 1
+    doc_of_token = np.repeat(np.arange(num_docs), np.diff(doc_starts))
+    doc_words = sparse.csc_matrix((np.ones(len(word_ids)), (doc_of_token, word_ids)),
+                                  shape=(num_docs, vocab_size))
+    doc_words.data[:] = 1
+    scores = []
+    for words in topic_words:
+        occur = doc_words[:, words]
+        # co-document frequencies, with document frequencies on the diagonal
+        codf = (occur.T @ occur).toarray()
+        score = 0.0
+        for i in range(1, len(words)):
+            for j in range(i):
+                score += np.log((codf[i, j] + 1) / max(codf[j, j], 1))
+        scores.append(score)
+    return np.array(scores)
+
+class TopicModelBackend(object):
+    '''
+    Subclasses implement train(), which fits @num_topics topics and writes
+    doc-topics.gz and topic-words.gz to @output_dir.
+    @word_ids: in-vocabulary word id of every token
+    @doc_starts: offset where each doc starts in @word_ids, plus the total at the end
+    '''
+    name = None
+
+    def train(self, output_dir, num_topics, word_ids, doc_starts, vocab_size):
+        raise NotImplementedError
+
+class MalletBackend(TopicModelBackend):
+    name = 'mallet'
+
+    def __init__(self, mallet_dir):
+        self.mallet_dir = mallet_dir
+
+    def train(self, output_dir, num_topics, word_ids=None, doc_starts=None, vocab_size=None):
+        # mallet reads data.input from output_dir, so the arrays are not needed
+        if not self.mallet_dir or not os.path.exists(os.path.join(self.mallet_dir, 'mallet')):
+            sys.exit("Error: Unable to find mallet at %s" % self.mallet_dir)
+        os.system("./mallet.sh %s %s %d" % (self.mallet_dir,
+                                            output_dir,
+                                            num_topics))
+
+class GibbsBackend(TopicModelBackend):
+    '''
+    Sparse collapsed Gibbs sampling for LDA (SparseLDA, see _sample) with a
+    symmetric Dirichlet prior, defaulting to MALLET's hyperparameters
+    (alpha summing to 5, beta 0.01). Doc-topic counts are rebuilt per doc
+    from the topic assignments, so memory is one int per token plus the
+    vocab x topics counts and nonzero topic lists, rather than a docs x
+    topics matrix.
+    '''
+    name = 'gibbs'
+
+    def __init__(self, num_iterations=1000, alpha_sum=5.0, beta=0.01,
+                 report_every=50, num_top_words=20, seed=0):
+        self.num_iterations = num_iterations
+        self.alpha_sum = alpha_sum
+        self.beta = beta
+        self.report_every = report_every
+        self.num_top_words = num_top_words
+        self.seed = seed
+        # (iteration, seconds since start, log likelihood per token)
+        self.history = []
+
+    def fit(self, num_topics, word_ids, doc_starts, vocab_size, num_iterations=None):
+        '''
+        Samples topic assignments and returns (z, word x topic counts).
+        '''
+        if num_iterations is None:
+            num_iterations = self.num_iterations
+        alpha = np.full(num_topics, self.alpha_sum / num_topics)
+        _seed(self.seed)
+        rng = np.random.RandomState(self.seed)
+        z = rng.randint(0, num_topics, size=len(word_ids)).astype(np.int32)
+        n_wk = np.zeros((vocab_size, num_topics), dtype=np.int32)
+        np.add.at(n_wk, (word_ids, z), 1)
+        n_k = n_wk.sum(axis=0).astype(np.int32)
+        self.history = []
+        start = time.perf_counter()
+        done = 0
+        while done < num_iterations:
+            steps = min(self.report_every, num_iterations - done)
+            _sample(word_ids, doc_starts, z, n_wk, n_k, alpha, self.beta, steps)
+            done += steps
+            ll = _log_likelihood(doc_starts, z, n_wk, n_k, alpha, self.beta) / max(len(word_ids), 1)
+            elapsed = time.perf_counter() - start
+            self.history.append((done, elapsed, ll))
+            logging.info("gibbs iteration %d/%d, %.1f iterations/sec, LL/token %.5f",
+                         done, num_iterations, done / elapsed, ll)
+        return z, n_wk
+
+    def train(self, output_dir, num_topics, word_ids, doc_starts, vocab_size):
+        z, n_wk = self.fit(num_topics, word_ids, doc_starts, vocab_size)
+        alpha = np.full(num_topics, self.alpha_sum / num_topics)
+        write_doc_topics('%s/doc-topics.gz' % output_dir, z, doc_starts, alpha)
+        write_topic_words('%s/topic-words.gz' % output_dir, n_wk, alpha,
+                          top=self.num_top_words)
+
+def write_doc_topics(filename, z, doc_starts, alpha, chunk_size=10000):
+    '''
+    One line per doc: doc index, doc name (its 1-based line in data.input),
+    then the proportion of each topic in topic order.
+    '''
+    num_topics = len(alpha)
+    num_docs = len(doc_starts) - 1
+    lengths = np.diff(doc_starts)
+    doc_of_token = np.repeat(np.arange(num_docs), lengths)
+    with open(filename, 'w') as fout:
+        for first in range(0, num_docs, chunk_size):
+            last = min(first + chunk_size, num_docs)
+            tokens = slice(doc_starts[first], doc_starts[last])
+            counts = np.zeros((last - first, num_topics))
+            np.add.at(counts, (doc_of_token[tokens] - first, z[tokens]), 1)
+            props = (counts + alpha) / (lengths[first:last, None] + alpha.sum())
+            for i, row in enumerate(props):
+                fout.write("%d\t%d\t%s\n" % (first + i, first + i + 1,
+                                             "\t".join(["%g" % p for p in row])))
+
+def write_topic_words(filename, n_wk, alpha, top=20):
+    '''
+    One line per topic: topic id, its alpha, then its most frequent word ids.
+    '''
+    with open(filename, 'w') as fout:
+        for k in range(n_wk.shape[1]):
+            counts = n_wk[:, k]
+            # stable sort so ties keep word id order
+            top_words = np.argsort(-counts, kind='stable')[:top]
+            top_words = [str(w) for w in top_words if counts[w] > 0]
+            fout.write("%d\t%g\t%s\n" % (k, alpha[k], " ".join(top_words)))
+
+@jit
+def _seed(seed):
+    np.random.seed(seed)
+
+@jit
+def _remove_topic(topics, pos, nnz, k):
+    # the last topic in the list takes k's place
+    j = pos[k]
+    last = topics[nnz - 1]
+    topics[j] = last
+    pos[last] = j
+    pos[k] = -1
+    return nnz - 1
+
+@jit
+def _add_topic(topics, pos, nnz, k):
+    topics[nnz] = k
+    pos[k] = nnz
+    return nnz + 1
+
+@jit
+def _sample(word_ids, doc_starts, z, n_wk, n_k, alpha, beta, num_iterations):
+    '''
+    SparseLDA (Yao, Mimno and McCallum 2009). The weight of topic t for a
+    token of word w in doc d, (alpha_t + n_dt)(beta + n_wt) / (vbeta + n_t),
+    is split into three buckets:
+    - s: alpha_t beta / (vbeta + n_t), the same for every token
+    - r: n_dt beta / (vbeta + n_t), over the topics in the doc
+    - q: (alpha_t + n_dt) n_wt / (vbeta + n_t), over the topics of the word
+    s and r are kept up to date as counts change, so a draw costs the
+    number of topics of the word (and rarely of the doc), not num_topics.
+    '''
+    num_topics = n_k.shape[0]
+    vocab_size = n_wk.shape[0]
+    vbeta = vocab_size * beta
+    # topics with a nonzero count for each word, and where each one is in the list
+    word_topics = np.zeros((vocab_size, num_topics), dtype=np.int32)
+    word_pos = np.full((vocab_size, num_topics), -1, dtype=np.int32)
+    word_nnz = np.zeros(vocab_size, dtype=np.int32)
+    for w in range(vocab_size):
+        for t in range(num_topics):
+            if n_wk[w, t] > 0:
+                word_nnz[w] = _add_topic(word_topics[w], word_pos[w], word_nnz[w], t)
+    doc_topics = np.zeros(num_topics, dtype=np.int32)
+    doc_pos = np.full(num_topics, -1, dtype=np.int32)
+    n_dk = np.zeros(num_topics, dtype=np.int32)
+    # (alpha_t + n_dt) / (vbeta + n_t) for the current doc
+    coef = np.zeros(num_topics)
+    q = np.zeros(num_topics)
+    for _ in range(num_iterations):
+        # recomputed every iteration so rounding errors do not add up
+        s_total = 0.0
+        for t in range(num_topics):
+            s_total += alpha[t] * beta / (n_k[t] + vbeta)
+            coef[t] = alpha[t] / (n_k[t] + vbeta)
+        for d in range(doc_starts.shape[0] - 1):
+            start = doc_starts[d]
+            end = doc_starts[d + 1]
+            doc_nnz = 0
+            for i in range(start, end):
+                k = z[i]
+                if n_dk[k] == 0:
+                    doc_nnz = _add_topic(doc_topics, doc_pos, doc_nnz, k)
+                n_dk[k] += 1
+            r_total = 0.0
+            for j in range(doc_nnz):
+                t = doc_topics[j]
+                r_total += n_dk[t] * beta / (n_k[t] + vbeta)
+                coef[t] = (alpha[t] + n_dk[t]) / (n_k[t] + vbeta)
+            for i in range(start, end):
+                w = word_ids[i]
+                k = z[i]
+                # take the token out
+                denom = n_k[k] + vbeta
+                s_total -= alpha[k] * beta / denom
+                r_total -= n_dk[k] * beta / denom
+                n_dk[k] -= 1
+                n_wk[w, k] -= 1
+                n_k[k] -= 1
+                denom = n_k[k] + vbeta
+                s_total += alpha[k] * beta / denom
+                r_total += n_dk[k] * beta / denom
+                coef[k] = (alpha[k] + n_dk[k]) / denom
+                if n_dk[k] == 0:
+                    doc_nnz = _remove_topic(doc_topics, doc_pos, doc_nnz, k)
+                if n_wk[w, k] == 0:
+                    word_nnz[w] = _remove_topic(word_topics[w], word_pos[w], word_nnz[w], k)
+
+                q_total = 0.0
+                for j in range(word_nnz[w]):
+                    t = word_topics[w, j]
+                    q[j] = coef[t] * n_wk[w, t]
+                    q_total += q[j]
+                u = np.random.random() * (s_total + r_total + q_total)
+                if u < q_total:
+                    j = 0
+                    while j < word_nnz[w] - 1 and u >= q[j]:
+                        u -= q[j]
+                        j += 1
+                    k = word_topics[w, j]
+                elif u < q_total + r_total and doc_nnz > 0:
+                    u -= q_total
+                    j = 0
+                    k = doc_topics[0]
+                    while j < doc_nnz:
+                        k = doc_topics[j]
+                        u -= n_dk[k] * beta / (n_k[k] + vbeta)
+                        if u < 0:
+                            break
+                        j += 1
+                else:
+                    u -= q_total + r_total
+                    k = 0
+                    while k < num_topics - 1:
+                        u -= alpha[k] * beta / (n_k[k] + vbeta)
+                        if u < 0:
+                            break
+                        k += 1
+
+                # put it back in topic k
+                denom = n_k[k] + vbeta
+                s_total -= alpha[k] * beta / denom
+                r_total -= n_dk[k] * beta / denom
+                if n_dk[k] == 0:
+                    doc_nnz = _add_topic(doc_topics, doc_pos, doc_nnz, k)
+                if n_wk[w, k] == 0:
+                    word_nnz[w] = _add_topic(word_topics[w], word_pos[w], word_nnz[w], k)
+                n_dk[k] += 1
+                n_wk[w, k] += 1
+                n_k[k] += 1
+                denom = n_k[k] + vbeta
+                s_total += alpha[k] * beta / denom
+                r_total += n_dk[k] * beta / denom
+                coef[k] = (alpha[k] + n_dk[k]) / denom
+                z[i] = k
+            # topics of this doc go back to the empty doc coefficient
+            for j in range(doc_nnz):
+                t = doc_topics[j]
+                n_dk[t] = 0
+                doc_pos[t] = -1
+                coef[t] = alpha[t] / (n_k[t] + vbeta)
+
+@jit
+def _log_likelihood(doc_starts, z, n_wk, n_k, alpha, beta):
+    '''
+    log p(w, z) of the current assignments, up to a constant.
+    '''
+    num_topics = n_k.shape[0]
+    vocab_size = n_wk.shape[0]
+    alpha_sum = alpha.sum()
+    ll = 0.0
+    n_dk = np.zeros(num_topics, dtype=np.int32)
+    for d in range(doc_starts.shape[0] - 1):
+        n_dk[:] = 0
+        for i in range(doc_starts[d], doc_starts[d + 1]):
+            n_dk[z[i]] += 1
+        for t in range(num_topics):
+            if n_dk[t] > 0:
+                ll += math.lgamma(n_dk[t] + alpha[t]) - math.lgamma(alpha[t])
+        ll += math.lgamma(alpha_sum) - math.lgamma(doc_starts[d + 1] - doc_starts[d] + alpha_sum)
+    for t in range(num_topics):
+        for w in range(vocab_size):
+            if n_wk[w, t] > 0:
+                ll += math.lgamma(n_wk[w, t] + beta) - math.lgamma(beta)
+        ll += math.lgamma(vocab_size * beta) - math.lgamma(n_k[t] + vocab_size * beta)
+    return ll